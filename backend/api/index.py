@@ -1,4 +1,6 @@
+import heapq
 import json
+import math
 import os
 import random
 import secrets
@@ -42,6 +44,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             return handle_verify(event, cur, conn)
         elif endpoint == 'projects':
             return handle_projects(event, cur, conn)
+        elif endpoint == 'recut':
+            return handle_recut(event, cur, conn)
         else:
             return {
                 'statusCode': 400,
@@ -449,4 +453,203 @@ def handle_projects(event: Dict[str, Any], cur, conn) -> Dict[str, Any]:
         'statusCode': 405,
         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
         'body': json.dumps({'error': 'Method not allowed'})
+    }
+
+DENDROGRAM_VERSION = 2
+
+def handle_recut(event: Dict[str, Any], cur, conn) -> Dict[str, Any]:
+    '''
+    Перерезка кластеров проекта по сохранённой дендрограмме (wordstat с
+    return_dendrogram и project_id) — без запроса к Wordstat и пересчёта
+    Body: {"id": проект} или {"dendrogram": дендрограмма из ответа wordstat}, и
+          "threshold": минимальная близость слияния, "targetClusters": N и/или
+          "merges": не больше N слияний (merges = applied_merges — исходный ответ)
+    Дендрограмма из тела не читает данные пользователя и обходится без сессии
+    '''
+    method = event.get('httpMethod', 'GET')
+    
+    if method != 'POST':
+        return {
+            'statusCode': 405,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Method not allowed'})
+        }
+    
+    body_data = json.loads(event.get('body') or '{}')
+    project_id = body_data.get('id')
+    dendrogram = body_data.get('dendrogram')
+    threshold = body_data.get('threshold')
+    target_clusters = body_data.get('targetClusters')
+    max_merges = body_data.get('merges')
+    
+    if dendrogram is None:
+        headers = event.get('headers', {})
+        session_token = headers.get('x-session-token') or headers.get('X-Session-Token')
+        user_id = verify_session(cur, session_token)
+        
+        if not user_id:
+            return {
+                'statusCode': 401,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Invalid or expired session'})
+            }
+    
+    if (not project_id and dendrogram is None) or (threshold is None and target_clusters is None and max_merges is None):
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Project ID or dendrogram and threshold, targetClusters or merges are required'})
+        }
+    
+    try:
+        threshold = float(threshold) if threshold is not None else None
+        target_clusters = int(target_clusters) if target_clusters is not None else None
+        max_merges = int(max_merges) if max_merges is not None else None
+    except (ValueError, TypeError):
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'threshold must be a number, targetClusters and merges must be integers'})
+        }
+    
+    if (threshold is not None and not math.isfinite(threshold)) or (target_clusters is not None and target_clusters < 1) or (max_merges is not None and max_merges < 0):
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'threshold must be finite, targetClusters at least 1, merges not negative'})
+        }
+    
+    if dendrogram is None:
+        cur.execute("SELECT dendrogram FROM clustering_projects WHERE id = %s AND user_id = %s", (project_id, user_id))
+        result = cur.fetchone()
+        
+        if not result:
+            return {
+                'statusCode': 404,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Project not found'})
+            }
+        
+        if not result[0]:
+            return {
+                'statusCode': 404,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Project has no saved dendrogram'})
+            }
+        
+        dendrogram = result[0]
+    
+    if not isinstance(dendrogram, dict) or dendrogram.get('version') != DENDROGRAM_VERSION:
+        return {
+            'statusCode': 409,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Unsupported dendrogram version, re-run clustering'})
+        }
+    
+    clusters, merges = cut_dendrogram(dendrogram, threshold, target_clusters, max_merges)
+    
+    response = {
+        'clusters': clusters,
+        'clustersCount': len(clusters),
+        'merges': merges,
+        'minSimilarity': dendrogram['min_similarity']
+    }
+    # На applied_merges перерезка обязана повторить исходный ответ wordstat
+    cut = dendrogram['cut']
+    if merges == cut['merges']:
+        summary = [[c['cluster_name'], c['phrases_count'], c['total_count']] for c in clusters]
+        response['matchesOriginal'] = summary == cut['clusters']
+        if not response['matchesOriginal']:
+            print(f'[RECUT] Drift from wordstat at {merges} merges: {summary} != {cut["clusters"]}')
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps(response, ensure_ascii=False)
+    }
+
+def cut_dendrogram(dendrogram: Dict[str, Any], threshold: Optional[float], target_clusters: Optional[int], max_merges: Optional[int] = None) -> tuple:
+    '''
+    Кластеры после префикса слияний: пока близость не ниже threshold,
+    кластеров больше target_clusters и слияний меньше max_merges. Повторяет replay_merges и
+    build_named_clusters из backend/wordstat — при applied_merges слияниях
+    результат совпадает с исходным ответом. Ниже min_similarity слияний нет
+    Returns: (clusters, число применённых слияний)
+    '''
+    phrases = dendrogram['phrases']
+    counts = [p['count'] for p in phrases]
+    lemmas = dendrogram['lemmas']
+    n = len(phrases)
+    
+    members = {i: [i] for i in range(n)}
+    anchor = list(range(n))
+    for a, b, similarity in dendrogram['merges']:
+        if threshold is not None and similarity < threshold:
+            break
+        if target_clusters is not None and len(members) <= target_clusters:
+            break
+        if max_merges is not None and n - len(members) >= max_merges:
+            break
+        first, second = (a, b) if anchor[a] < anchor[b] else (b, a)
+        winner = first if counts[first] >= counts[second] else second
+        merged = members.pop(first) + members.pop(second)
+        members[winner] = merged
+        anchor[winner] = anchor[first]
+    
+    clusters = []
+    for center in sorted(members, key=lambda c: anchor[c]):
+        indices = members[center]
+        sorted_phrases = [phrases[i] for i in sorted(indices, key=counts.__getitem__, reverse=True)]
+        
+        lemmas_counter = {}
+        intent_counts = {}
+        for idx in indices:
+            for lemma_id in dendrogram['phrase_lemmas'][idx]:
+                lemmas_counter[lemma_id] = lemmas_counter.get(lemma_id, 0) + 1
+            intent = dendrogram['intents'][idx]
+            intent_counts[intent] = intent_counts.get(intent, 0) + 1
+        
+        if lemmas_counter:
+            top_words = [lemmas[w] for w, _ in heapq.nlargest(2, lemmas_counter.items(), key=lambda x: x[1])]
+            cluster_name = ' '.join(top_words).title()
+        else:
+            cluster_name = ' '.join(sorted_phrases[0]['phrase'].split()[:2]).title()
+        
+        clusters.append(cluster_fields(cluster_name, max(intent_counts.items(), key=lambda x: x[1])[0], sorted_phrases))
+    
+    clusters.sort(key=lambda x: x['total_count'], reverse=True)
+    
+    if dendrogram['competitors']:
+        clusters.append(cluster_fields(
+            'Агрегаторы и конкуренты',
+            'general',
+            sorted(dendrogram['competitors'], key=lambda x: x['count'], reverse=True)
+        ))
+    
+    # Почти одинаковые фразы кластеризовались одним представителем
+    duplicates = dendrogram.get('duplicates') or {}
+    if duplicates:
+        for i, cluster in enumerate(clusters):
+            expanded = []
+            for p in cluster['phrases']:
+                expanded.extend(duplicates.get(p['phrase'], [p]))
+            if len(expanded) != len(cluster['phrases']):
+                expanded.sort(key=lambda x: x['count'], reverse=True)
+                clusters[i] = cluster_fields(cluster['cluster_name'], cluster['intent'], expanded)
+    
+    return clusters, n - len(members)
+
+def cluster_fields(name: str, intent: str, phrases: list) -> Dict[str, Any]:
+    '''Кластер в формате ответа wordstat (phrases уже отсортированы по частотности)'''
+    counts = [p.get('count', 0) for p in phrases]
+    words = sum(len(p['phrase'].split()) for p in phrases)
+    return {
+        'cluster_name': name,
+        'total_count': sum(counts),
+        'phrases_count': len(phrases),
+        'avg_words': round(words / len(phrases), 1) if phrases else 0,
+        'max_frequency': max(counts) if counts else 0,
+        'min_frequency': min(counts) if counts else 0,
+        'intent': intent,
+        'phrases': phrases
     }
\ No newline at end of file
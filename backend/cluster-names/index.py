@@ -1,7 +1,76 @@
 import json
 import os
-from typing import Dict, Any, List
+import hashlib
+from typing import Dict, Any, List, Optional
 from openai import OpenAI
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+MODEL = 'gpt-4o-mini'
+# Версия шаблона промпта входит в ключ кэша: правка промпта — новая версия
+PROMPT_VERSION = 'cluster-names-v1'
+MEMORY_CACHE_SIZE = 256
+
+memory_cache: Dict[str, Any] = {}
+cache_stats = {'memory_hits': 0, 'db_hits': 0, 'misses': 0}
+
+def cache_key(keywords: List[str], params: Dict[str, Any]) -> str:
+    '''sha256 от (модель, версия промпта, отсортированный набор фраз, параметры)'''
+    payload = json.dumps({
+        'model': MODEL,
+        'prompt_version': PROMPT_VERSION,
+        'items': sorted(keywords),
+        'params': params
+    }, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def load_cached(key: str) -> Optional[Any]:
+    if key in memory_cache:
+        cache_stats['memory_hits'] += 1
+        return memory_cache[key]
+    try:
+        dsn = os.environ.get('DATABASE_URL')
+        conn = psycopg2.connect(dsn, cursor_factory=RealDictCursor)
+        cur = conn.cursor()
+        cur.execute(
+            "UPDATE llm_cache SET hits = hits + 1, last_hit_at = CURRENT_TIMESTAMP WHERE cache_key = %s RETURNING response",
+            (key,)
+        )
+        row = cur.fetchone()
+        conn.commit()
+        cur.close()
+        conn.close()
+    except Exception as e:
+        print(f'[LLM CACHE] Load error: {e}')
+        return None
+    if not row:
+        return None
+    cache_stats['db_hits'] += 1
+    remember(key, row['response'])
+    return row['response']
+
+def remember(key: str, value: Any):
+    if len(memory_cache) >= MEMORY_CACHE_SIZE:
+        memory_cache.pop(next(iter(memory_cache)))
+    memory_cache[key] = value
+
+def store_cached(key: str, value: Any):
+    remember(key, value)
+    try:
+        dsn = os.environ.get('DATABASE_URL')
+        conn = psycopg2.connect(dsn)
+        cur = conn.cursor()
+        cur.execute(
+            """INSERT INTO llm_cache (cache_key, kind, model, prompt_version, response)
+               VALUES (%s, %s, %s, %s, %s)
+               ON CONFLICT (cache_key) DO NOTHING""",
+            (key, 'cluster_names', MODEL, PROMPT_VERSION, json.dumps(value, ensure_ascii=False))
+        )
+        conn.commit()
+        cur.close()
+        conn.close()
+    except Exception as e:
+        print(f'[LLM CACHE] Store error: {e}')
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
@@ -55,6 +124,22 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'body': json.dumps({'error': 'OpenAI API key not configured'})
         }
     
+    key = cache_key(keywords[:100], {'temperature': 0.7, 'max_tokens': 500})
+    cluster_names = load_cached(key)
+    if cluster_names is not None:
+        print(f'[LLM CACHE] Hit {key[:12]}, stats: {cache_stats}')
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'isBase64Encoded': False,
+            'body': json.dumps({
+                'clusterNames': cluster_names,
+                'totalKeywords': len(keywords),
+                'cached': True
+            })
+        }
+    cache_stats['misses'] += 1
+    
     client_kwargs = {'api_key': api_key}
     if proxy_url:
         import httpx
@@ -80,7 +165,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
 ["Название 1", "Название 2", ...]"""
 
     response = client.chat.completions.create(
-        model='gpt-4o-mini',
+        model=MODEL,
         messages=[
             {'role': 'system', 'content': 'Ты эксперт по маркетингу и кластеризации семантики для контекстной рекламы.'},
             {'role': 'user', 'content': prompt}
@@ -97,6 +182,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         content = content.replace('```', '').strip()
     
     cluster_names = json.loads(content)
+    store_cached(key, cluster_names)
     
     return {
         'statusCode': 200,
@@ -104,6 +190,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         'isBase64Encoded': False,
         'body': json.dumps({
             'clusterNames': cluster_names,
-            'totalKeywords': len(keywords)
+            'totalKeywords': len(keywords),
+            'cached': False
         })
     }
\ No newline at end of file
@@ -1,11 +1,22 @@
 import json
 import os
-from typing import Dict, Any
+from typing import Dict, Any, List
 import requests
 import psycopg2
 from psycopg2.extras import RealDictCursor
 from datetime import datetime
+from collections import defaultdict
+import math
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+STOP_WORDS = {
+    'в', 'на', 'с', 'по', 'для', 'из', 'и', 'или', 'как', 'что', 'за',
+    'это', 'то', 'так', 'но', 'а', 'о', 'у', 'от', 'к', 'до', 'при',
+    'без', 'под', 'над', 'между', 'перед', 'через', 'после'
+}
+
+CENTROID_MAX_TERMS = 30
 
 def check_subscription(user_id: str) -> bool:
     try:
@@ -37,6 +48,160 @@ def check_subscription(user_id: str) -> bool:
     except Exception:
         return False
 
+def tokenize(phrase: str) -> List[str]:
+    return [w for w in phrase.lower().split() if w not in STOP_WORDS and len(w) > 2]
+
+def update_incremental_clusters(state: Dict[str, Any], page_phrases: List[Dict[str, Any]], start_index: int, mode: str) -> Dict[str, Any]:
+    '''
+    Инкрементальная кластеризация новой страницы фраз
+    В state хранятся счётчики документов для IDF и центроиды кластеров,
+    поэтому каждая страница относится к уже существующим кластерам
+    (или создаёт новые) без пересчёта всей коллекции
+    Args:
+        state: {'n_docs', 'df', 'clusters': [{'centroid', 'members'}]} или пустой dict
+        page_phrases: фразы новой страницы
+        start_index: индекс первой фразы страницы в общем списке phrases
+        mode: 'context' или 'seo' — как в clusterize_advanced
+    Returns: обновлённый state
+    '''
+    similarity_threshold = 0.15 if mode == 'context' else 0.2
+    
+    n_docs = state.get('n_docs', 0)
+    df = defaultdict(int, state.get('df', {}))
+    clusters = state.get('clusters', [])
+    
+    page_words = [tokenize(p['phrase']) for p in page_phrases]
+    for words in page_words:
+        for word in set(words):
+            df[word] += 1
+    n_docs += len(page_phrases)
+    
+    # Инвертированный индекс терм → кластеры, чтобы не сравнивать с каждым центроидом
+    term_clusters = defaultdict(set)
+    centroid_norms = []
+    for cluster_idx, cluster in enumerate(clusters):
+        for word in cluster['centroid']:
+            term_clusters[word].add(cluster_idx)
+        centroid_norms.append(math.sqrt(sum(v * v for v in cluster['centroid'].values())))
+    
+    for offset, words in enumerate(page_words):
+        phrase_idx = start_index + offset
+        
+        word_count = defaultdict(int)
+        for word in words:
+            word_count[word] += 1
+        vector = {w: c / len(words) * math.log(n_docs / df[w]) for w, c in word_count.items()}
+        norm = math.sqrt(sum(v * v for v in vector.values()))
+        if norm > 0:
+            vector = {w: v / norm for w, v in vector.items() if v > 0}
+        else:
+            vector = {}
+        
+        best_idx = None
+        best_sim = similarity_threshold
+        candidates = set()
+        for word in vector:
+            candidates.update(term_clusters.get(word, ()))
+        for cluster_idx in sorted(candidates):
+            centroid = clusters[cluster_idx]['centroid']
+            if centroid_norms[cluster_idx] == 0:
+                continue
+            sim = sum(v * centroid.get(w, 0) for w, v in vector.items()) / centroid_norms[cluster_idx]
+            if sim >= best_sim:
+                best_idx, best_sim = cluster_idx, sim
+        
+        if best_idx is None:
+            clusters.append({'centroid': dict(vector), 'members': [phrase_idx]})
+            best_idx = len(clusters) - 1
+            centroid_norms.append(1.0 if vector else 0.0)
+        else:
+            cluster = clusters[best_idx]
+            cluster['members'].append(phrase_idx)
+            centroid = cluster['centroid']
+            for w, v in vector.items():
+                centroid[w] = centroid.get(w, 0) + v
+            if len(centroid) > CENTROID_MAX_TERMS:
+                top_terms = sorted(centroid.items(), key=lambda x: x[1], reverse=True)[:CENTROID_MAX_TERMS]
+                for w in list(centroid):
+                    term_clusters[w].discard(best_idx)
+                cluster['centroid'] = centroid = dict(top_terms)
+            centroid_norms[best_idx] = math.sqrt(sum(v * v for v in centroid.values()))
+        
+        for word in clusters[best_idx]['centroid']:
+            term_clusters[word].add(best_idx)
+    
+    return {'n_docs': n_docs, 'df': dict(df), 'clusters': clusters}
+
+def build_clusters_response(state: Dict[str, Any], phrases: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    '''Кластеры коллекции в формате wordstat (cluster_name, total_count, phrases...)'''
+    result = []
+    for cluster in (state or {}).get('clusters', []):
+        cluster_phrases = [phrases[i] for i in cluster['members'] if i < len(phrases)]
+        if not cluster_phrases:
+            continue
+        top_words = sorted(cluster['centroid'].items(), key=lambda x: x[1], reverse=True)[:2]
+        if top_words:
+            cluster_name = ' '.join(w for w, _ in top_words).title()
+        else:
+            cluster_name = ' '.join(cluster_phrases[0]['phrase'].split()[:2]).title()
+        
+        result.append({
+            'cluster_name': cluster_name,
+            'total_count': sum(p['count'] for p in cluster_phrases),
+            'phrases_count': len(cluster_phrases),
+            'max_frequency': max(p['count'] for p in cluster_phrases),
+            'min_frequency': min(p['count'] for p in cluster_phrases),
+            'phrases': sorted(cluster_phrases, key=lambda x: x['count'], reverse=True)
+        })
+    
+    result.sort(key=lambda x: x['total_count'], reverse=True)
+    return result
+
+COLLECT_WORKERS = int(os.environ.get('COLLECT_WORKERS', '8'))
+
+def normalize_phrase(phrase: str) -> str:
+    return ' '.join(phrase.lower().split())
+
+def fetch_seed_pages(api_url: str, api_headers: Dict[str, str], seeds: List[str], regions: List[int], num_phrases: int) -> List[tuple]:
+    '''
+    Выдача для всех сидов параллельно (ограниченный пул потоков).
+    Возвращает (status_code, data) по уникальным сидам в исходном порядке; ошибки сидов логируются
+    '''
+    unique = {}
+    for seed in seeds:
+        if seed.strip():
+            unique.setdefault(normalize_phrase(seed), seed.strip())
+    
+    def fetch(seed: str) -> tuple:
+        try:
+            payload = {'phrase': seed, 'regions': regions, 'numPhrases': num_phrases}
+            response = requests.post(api_url, json=payload, headers=api_headers, timeout=30)
+            if response.status_code != 200:
+                print(f'[COLLECT] Seed "{seed}" API error: {response.status_code}')
+                return response.status_code, None
+            return 200, response.json()
+        except Exception as e:
+            print(f'[COLLECT] Seed "{seed}" failed: {e}')
+            return None, None
+    
+    if not unique:
+        return []
+    with ThreadPoolExecutor(max_workers=min(COLLECT_WORKERS, len(unique))) as executor:
+        return list(executor.map(fetch, unique.values()))
+
+def merge_seed_pages(pages: List[List[Dict[str, Any]]], collected: set) -> List[Dict[str, Any]]:
+    '''Одна запись на нормализованную фразу с максимальной частотностью, без уже собранных'''
+    merged = {}
+    for page_items in pages:
+        for item in page_items:
+            key = normalize_phrase(item['phrase'])
+            if key in collected:
+                continue
+            current = merged.get(key)
+            if current is None or item['count'] > current['count']:
+                merged[key] = item
+    return sorted(merged.values(), key=lambda x: x['count'], reverse=True)
+
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Постраничный сбор ключевых фраз из Wordstat с сохранением в БД
@@ -118,7 +283,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'status': collection['status'],
                 'current_page': collection['current_page'],
                 'total_pages': collection['total_pages'],
-                'phrases': collection['phrases']
+                'phrases': collection['phrases'],
+                'clusters': build_clusters_response(collection['cluster_state'], collection['phrases'] or [])
             }),
             'isBase64Encoded': False
         }
@@ -147,6 +313,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     collection_id = body_data.get('collection_id')
     mode = body_data.get('mode', 'context')
     
+    # Пустые сиды не запрашиваются: если других нет, это ошибка запроса, а не API
+    keywords = [k for k in keywords if isinstance(k, str) and k.strip()] if isinstance(keywords, list) else []
     if not keywords:
         return {
             'statusCode': 400,
@@ -177,54 +345,53 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     num_phrases_per_page = 50
     start_index = (page - 1) * num_phrases_per_page
     
-    payload = {
-        'phrase': keywords[0],
-        'regions': regions,
-        'numPhrases': page * num_phrases_per_page
-    }
-    
-    print(f'[COLLECT] Collecting page {page} for "{keywords[0]}" (phrases {start_index}-{start_index + num_phrases_per_page})')
+    print(f'[COLLECT] Collecting page {page} for {len(keywords)} seeds, first "{keywords[0]}" (phrases {start_index}-{start_index + num_phrases_per_page})')
     
-    response = requests.post(api_url, json=payload, headers=api_headers, timeout=30)
+    seed_responses = fetch_seed_pages(api_url, api_headers, keywords, regions, page * num_phrases_per_page)
+    seed_tops = [data.get('topRequests', []) for status, data in seed_responses if status == 200]
     
-    if response.status_code != 200:
+    if not seed_tops:
         cur.close()
         conn.close()
+        status_code = seed_responses[0][0] if seed_responses else 502
         return {
-            'statusCode': response.status_code,
+            'statusCode': status_code or 502,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': f'API error: {response.status_code}'}),
+            'body': json.dumps({'error': f'API error: {status_code}'}),
             'isBase64Encoded': False
         }
     
-    data = response.json()
-    top_requests = data.get('topRequests', [])
-    
-    page_phrases = top_requests[start_index:start_index + num_phrases_per_page] if len(top_requests) > start_index else []
-    
     cur.execute(
-        "SELECT phrases FROM wordstat_collections WHERE id = %s",
+        "SELECT phrases, cluster_state FROM wordstat_collections WHERE id = %s",
         (collection_id,)
     )
     result = cur.fetchone()
     existing_phrases = result['phrases'] if result and result['phrases'] else []
+    cluster_state = result['cluster_state'] if result and result['cluster_state'] else {}
+    
+    # Страница каждого сида, слияние по нормализованной фразе (максимальная частотность)
+    # и отсев фраз, собранных на предыдущих страницах
+    collected = {normalize_phrase(p['phrase']) for p in existing_phrases}
+    page_phrases = merge_seed_pages([top[start_index:start_index + num_phrases_per_page] for top in seed_tops], collected)
     
     all_phrases = existing_phrases + page_phrases
+    cluster_state = update_incremental_clusters(cluster_state, page_phrases, len(existing_phrases), mode)
+    clusters = build_clusters_response(cluster_state, all_phrases)
     
-    total_available = len(top_requests)
+    total_available = max(len(top) for top in seed_tops)
     total_pages = (total_available + num_phrases_per_page - 1) // num_phrases_per_page
-    is_completed = page >= total_pages or len(page_phrases) < num_phrases_per_page
+    is_completed = page >= total_pages or total_available < page * num_phrases_per_page
     
     cur.execute(
-        "UPDATE wordstat_collections SET phrases = %s, current_page = %s, total_pages = %s, status = %s, updated_at = NOW() WHERE id = %s",
-        (json.dumps(all_phrases), page, total_pages, 'completed' if is_completed else 'processing', collection_id)
+        "UPDATE wordstat_collections SET phrases = %s, cluster_state = %s, current_page = %s, total_pages = %s, status = %s, updated_at = NOW() WHERE id = %s",
+        (json.dumps(all_phrases), json.dumps(cluster_state), page, total_pages, 'completed' if is_completed else 'processing', collection_id)
     )
     conn.commit()
     
     cur.close()
     conn.close()
     
-    print(f'[COLLECT] Saved page {page}/{total_pages}, total phrases: {len(all_phrases)}')
+    print(f'[COLLECT] Saved page {page}/{total_pages}, total phrases: {len(all_phrases)}, clusters: {len(clusters)}')
     
     return {
         'statusCode': 200,
@@ -238,6 +405,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'total_pages': total_pages,
             'phrases': page_phrases,
             'total_collected': len(all_phrases),
+            'clusters': clusters,
             'status': 'completed' if is_completed else 'processing'
         }),
         'isBase64Encoded': False
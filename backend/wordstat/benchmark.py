@@ -0,0 +1,281 @@
+'''
+Бенчмарк функций кластеризации wordstat на синтетических корпусах
+
+Генерирует похожие на выдачу Wordstat корпуса русских фраз (частотности
+по закону Ципфа, перестановки слов и предлоги как в реальных topRequests)
+и замеряет время, пиковую память и число кластеров.
+
+Запуск из backend/wordstat:
+    python benchmark.py                        # 500, 2k, 20k, 200k
+    python benchmark.py --sizes 500 2000 --output bench.json
+    python benchmark.py --sizes 2000 --payload  # размер и сериализация ответа
+'''
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Dict, Any, List, Callable
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import index
+
+DEFAULT_SIZES = [500, 2000, 20000, 200000]
+
+OBJECTS = [
+    'квартиры', 'квартир', 'дома', 'коттеджа', 'офиса', 'офисов', 'окон', 'дивана',
+    'ковров', 'ковра', 'матраса', 'кухни', 'ванной', 'балкона', 'фасада', 'подъезда',
+    'склада', 'магазина', 'ресторана', 'салона', 'мебели', 'штор', 'жалюзи', 'плитки',
+    'паркета', 'ламината', 'стекол', 'витрин', 'территории', 'помещений', 'бассейна',
+    'кресел', 'стульев', 'одеял', 'подушек', 'холодильника', 'духовки', 'вытяжки'
+]
+
+SERVICES = [
+    'уборка', 'клининг', 'мойка', 'мытье', 'химчистка', 'чистка', 'дезинфекция',
+    'генеральная уборка', 'уборка после ремонта', 'поддерживающая уборка',
+    'вывоз мусора', 'глажка', 'полировка', 'озонирование'
+]
+
+MODIFIERS = [
+    'цена', 'стоимость', 'недорого', 'дешево', 'заказать', 'купить', 'срочно',
+    'круглосуточно', 'отзывы', 'прайс', 'услуги', 'компания', 'на дому', 'выезд',
+    'эко', 'профессиональная', 'под ключ', 'за час', 'скидка', 'акция', 'телефон',
+    'сайт', 'рейтинг', 'лучшая', 'после пожара', 'после затопления', 'ежедневная'
+]
+
+CITIES = [
+    'москва', 'москве', 'спб', 'санкт петербург', 'казань', 'екатеринбург',
+    'новосибирск', 'краснодар', 'ставрополь', 'ростов', 'самара', 'уфа', 'пермь',
+    'воронеж', 'волгоград', 'омск', 'челябинск', 'тюмень', 'сочи', 'химки'
+]
+
+NOISE = [
+    'бесплатно', 'своими руками', 'авито', 'вакансии', 'работа', 'курсы', 'скачать',
+    'как выбрать', 'что такое', 'игры', 'самостоятельно', 'циан', 'юла', 'обучение'
+]
+
+PREPOSITIONS = ['в', 'на', 'для', 'по', 'с']
+
+SYLLABLES = ['ка', 'ро', 'ми', 'ст', 'ва', 'ле', 'но', 'ту', 'пре', 'зи', 'ол', 'ан', 'ер', 'дус', 'кин']
+
+def zipf_counts(n: int, rng: random.Random, exponent: float = 1.05, top: int = 250000) -> List[int]:
+    '''Частотности по закону Ципфа, отсортированные по убыванию (как в topRequests)'''
+    counts = [max(1, int(top / (rank ** exponent) * rng.uniform(0.8, 1.2))) for rank in range(1, n + 1)]
+    counts.sort(reverse=True)
+    return counts
+
+def generate_corpus(n: int, seed: int = 42) -> List[Dict[str, Any]]:
+    '''
+    Синтетический корпус Wordstat: услуга + объект + модификаторы/город,
+    ~10% нецелевых фраз, ~15% перестановок и вариантов с предлогами.
+    Для больших корпусов словарь расширяется псевдо-брендами (длинный хвост)
+    '''
+    rng = random.Random(seed)
+    brands = [''.join(rng.choice(SYLLABLES) for _ in range(3)) for _ in range(max(50, n // 40))]
+    
+    phrases = []
+    seen = set()
+    attempts = 0
+    while len(phrases) < n and attempts < n * 50:
+        attempts += 1
+        if phrases and rng.random() < 0.15:
+            words = rng.choice(phrases).split()
+            if rng.random() < 0.5:
+                rng.shuffle(words)
+            else:
+                words.insert(rng.randrange(len(words) + 1), rng.choice(PREPOSITIONS))
+        else:
+            words = [rng.choice(SERVICES), rng.choice(OBJECTS)]
+            for _ in range(rng.choice([0, 1, 1, 2, 2, 3])):
+                roll = rng.random()
+                if roll < 0.45:
+                    words.append(rng.choice(MODIFIERS))
+                elif roll < 0.75:
+                    words.append(rng.choice(CITIES))
+                elif roll < 0.9:
+                    words.append(rng.choice(brands))
+                else:
+                    words.append(rng.choice(NOISE))
+        phrase = ' '.join(words)
+        if phrase in seen:
+            continue
+        seen.add(phrase)
+        phrases.append(phrase)
+    
+    counts = zipf_counts(len(phrases), rng)
+    return [{'phrase': p, 'count': c} for p, c in zip(phrases, counts)]
+
+def count_clusters(result: Any) -> Any:
+    '''Число кластеров (или минус-категорий); для векторов TF-IDF — None'''
+    if isinstance(result, tuple):
+        return len(result[0])
+    if isinstance(result, dict):
+        return len(result)
+    if isinstance(result, list) and (not result or 'phrases' in result[0]):
+        return len(result)
+    return None
+
+def measure(func: Callable[[], Any]) -> Dict[str, Any]:
+    '''Время, пиковая память (tracemalloc, включая массивы NumPy) и размер результата'''
+    tracemalloc.start()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = func()
+    wall = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'wall_s': round(wall, 4),
+        'peak_mb': round(peak / 1024 / 1024, 2),
+        'clusters': count_clusters(result)
+    }
+
+def benchmark_cases(phrases: List[Dict[str, Any]], mode: str) -> Dict[str, Callable[[], Any]]:
+    '''Замеряемые функции; квадратичные ограничиваются --max-quadratic'''
+    return {
+        'clusterize_advanced': lambda: index.clusterize_advanced(phrases, mode=mode),
+        'clusterize_knn': lambda: index.clusterize_advanced(phrases, mode=mode, algorithm='knn'),
+        'clusterize_jaccard': lambda: index.clusterize_advanced(phrases, mode=mode, similarity='jaccard'),
+        'smart_clusterize': lambda: index.smart_clusterize(phrases, mode=mode),
+        'smart_jaccard': lambda: index.smart_clusterize(phrases, mode=mode, similarity='jaccard'),
+        'kmeans_clusterize': lambda: index.kmeans_clusterize(phrases, mode=mode),
+        'detect_minus_words': lambda: index.detect_minus_words(phrases),
+        'calculate_tfidf': lambda: index.calculate_tfidf([p['phrase'] for p in phrases])
+    }
+
+QUADRATIC_CASES = {'clusterize_advanced', 'clusterize_jaccard', 'smart_clusterize', 'smart_jaccard'}
+
+def run(sizes: List[int], modes: List[str], functions: List[str], max_quadratic: int, seed: int) -> Dict[str, Any]:
+    report = {'seed': seed, 'python': sys.version.split()[0], 'runs': []}
+    for size in sizes:
+        phrases = generate_corpus(size, seed)
+        for mode in modes:
+            for name, func in benchmark_cases(phrases, mode).items():
+                if functions and name not in functions:
+                    continue
+                entry = {'function': name, 'size': len(phrases), 'mode': mode}
+                if name in QUADRATIC_CASES and size > max_quadratic:
+                    entry['skipped'] = f'size > --max-quadratic ({max_quadratic})'
+                else:
+                    index.lemmatize_word.cache_clear()
+                    index.label_phrase.cache_clear()
+                    entry.update(measure(func))
+                report['runs'].append(entry)
+                print(json.dumps(entry, ensure_ascii=False), file=sys.stderr)
+    return report
+
+def build_search_query(phrases: List[Dict[str, Any]], mode: str) -> Dict[str, Any]:
+    '''SearchQuery как в ответе handler: топ, кластеры и минус-слова по корпусу'''
+    with contextlib.redirect_stdout(io.StringIO()):
+        clusters, minus_words = index.clusterize_advanced(phrases, mode=mode)
+    return {
+        'Keyword': phrases[0]['phrase'],
+        'Shows': phrases[0]['count'],
+        'TopRequests': phrases,
+        'Clusters': clusters,
+        'MinusWords': minus_words,
+        'Mode': mode,
+        'GeoCluster': None
+    }
+
+def payload_sizes(phrases: List[Dict[str, Any]], mode: str, runs: int = 5) -> List[Dict[str, Any]]:
+    '''Размер тела ответа и время сериализации: полный и компактный формат, без gzip и с gzip'''
+    search_query = build_search_query(phrases, mode)
+    formats = {
+        'full': lambda: {'success': True, 'data': {'SearchQuery': [search_query]}},
+        'compact': lambda: {'success': True, 'format': 'compact',
+                            'data': {'SearchQuery': [index.compact_search_query(search_query)]}}
+    }
+    entries = []
+    for name, build in formats.items():
+        for use_gzip in (False, True):
+            timings = []
+            for _ in range(runs):
+                start = time.perf_counter()
+                body, _, _ = index.encode_json_body(build(), use_gzip)
+                timings.append(time.perf_counter() - start)
+            raw = len(json.dumps(build(), ensure_ascii=False).encode('utf-8'))
+            entry = {'function': 'payload', 'format': name, 'gzip': use_gzip, 'size': len(phrases),
+                     'mode': mode, 'bytes': len(body.encode('utf-8')), 'json_bytes': raw,
+                     'wall_s': round(min(timings), 4)}
+            entries.append(entry)
+            print(json.dumps(entry, ensure_ascii=False), file=sys.stderr)
+    return entries
+
+COLD_START_SCRIPTS = {
+    # До ленивой загрузки импорт index сразу строил MorphAnalyzer — это import + get_morph()
+    'import': 'import index',
+    'import_eager_morph': 'import index; index.get_morph()',
+    'import_and_lemmatize': 'import index; index.PhraseTable([{"phrase": p, "count": 0} for p in PHRASES]).lemma_ids()'
+}
+
+def cold_start(phrases: List[Dict[str, Any]], runs: int = 5) -> List[Dict[str, Any]]:
+    '''
+    Холодный старт функции: каждый замер — новый интерпретатор.
+    Лемматизация меряется без файла лемм и с файлом (mmap), собранным по словам корпуса
+    '''
+    here = os.path.dirname(os.path.abspath(__file__))
+    words = sorted({w for p in phrases for w in p['phrase'].lower().split()})
+    store_path = os.path.join(tempfile.mkdtemp(), 'lemmas.tsv')
+    with contextlib.redirect_stdout(io.StringIO()):
+        index.build_lemma_store(words, store_path)
+    
+    variants = [('import', None), ('import_eager_morph', None),
+                ('import_and_lemmatize', os.devnull), ('import_and_lemmatize', store_path)]
+    entries = []
+    for name, lemma_store in variants:
+        env = dict(os.environ)
+        if lemma_store:
+            env['LEMMA_STORE_PATH'] = lemma_store
+        code = f'PHRASES = {json.dumps([p["phrase"] for p in phrases], ensure_ascii=False)}\n{COLD_START_SCRIPTS[name]}'
+        timings = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, '-c', code], cwd=here, env=env, check=True, stdout=subprocess.DEVNULL)
+            timings.append(time.perf_counter() - start)
+        entry = {'function': 'cold_start', 'case': name, 'size': len(phrases), 'wall_s': round(min(timings), 4)}
+        if lemma_store:
+            entry['lemma_store'] = lemma_store != os.devnull
+        entries.append(entry)
+        print(json.dumps(entry, ensure_ascii=False), file=sys.stderr)
+    return entries
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк кластеризации wordstat')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--modes', nargs='+', default=['context', 'seo'])
+    parser.add_argument('--functions', nargs='*', default=[])
+    parser.add_argument('--max-quadratic', type=int, default=20000,
+                        help='максимальный размер корпуса для квадратичных кластеризаторов')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='файл для JSON-отчёта (по умолчанию stdout)')
+    parser.add_argument('--cold-start', action='store_true',
+                        help='замерить холодный импорт функции и первую лемматизацию (корпус первого размера)')
+    parser.add_argument('--payload', action='store_true',
+                        help='сравнить размер и время сериализации полного и компактного ответа')
+    args = parser.parse_args()
+    
+    report = run(args.sizes, args.modes, args.functions, args.max_quadratic, args.seed)
+    if args.cold_start:
+        report['runs'].extend(cold_start(generate_corpus(args.sizes[0], args.seed)))
+    if args.payload:
+        for size in args.sizes:
+            for mode in args.modes:
+                report['runs'].extend(payload_sizes(generate_corpus(size, args.seed), mode))
+    
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
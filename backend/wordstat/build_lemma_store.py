@@ -0,0 +1,81 @@
+'''
+Сборка lemmas.tsv — файла лемм, который поставляется вместе с функцией wordstat
+
+index.lemmatize_word ищет словоформу в этом файле (mmap, бинарный поиск)
+до обращения к pymorphy3, поэтому холодный инстанс лемматизирует знакомые
+слова, не загружая словари. Файл только читается: пересобирайте его перед
+деплоем, чтобы он покрывал слова свежих выгрузок.
+
+Слова берутся из:
+    - словаря разметки index (маркеры интентов, минус-категории, стоп-слова)
+      во всех словоформах;
+    - фраз, накопленных в wordstat_cache (нужен DATABASE_URL);
+    - файла --words (по фразе или слову на строку).
+
+Запуск из backend/wordstat перед деплоем:
+    python build_lemma_store.py
+    python build_lemma_store.py --no-db --words phrases.txt
+'''
+
+import argparse
+import os
+import sys
+from typing import List, Set
+
+import psycopg2
+
+import index
+
+def vocabulary_words() -> Set[str]:
+    '''Слова словаря разметки index со всеми словоформами'''
+    seeds = set(index.COMMERCIAL_MARKERS) | set(index.INFO_MARKERS) | index.TFIDF_STOP_WORDS
+    for _, _, markers in index.MINUS_CATEGORIES:
+        seeds.update(markers)
+    
+    words = set()
+    for seed in seeds:
+        for word in seed.split():
+            words.add(word)
+            for form in index.get_morph().parse(word)[0].lexeme:
+                words.add(form.word)
+    return words
+
+def cached_phrase_words() -> Set[str]:
+    '''Слова всех фраз из wordstat_cache'''
+    dsn = os.environ.get('DATABASE_URL')
+    conn = psycopg2.connect(dsn)
+    cur = conn.cursor()
+    cur.execute("SELECT response FROM wordstat_cache")
+    words = set()
+    for (response,) in cur:
+        for top in response.get('topRequests', []):
+            words.update(top['phrase'].lower().split())
+    cur.close()
+    conn.close()
+    return words
+
+def file_words(path: str) -> Set[str]:
+    with open(path, encoding='utf-8') as f:
+        return {word for line in f for word in line.lower().split()}
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description='Сборка lemmas.tsv для функции wordstat')
+    parser.add_argument('--output', default=index.LEMMA_STORE_PATH)
+    parser.add_argument('--words', action='append', default=[], help='файл с фразами или словами')
+    parser.add_argument('--no-db', action='store_true', help='не читать wordstat_cache')
+    args = parser.parse_args(argv)
+    
+    words = vocabulary_words()
+    print(f'[LEMMA STORE] Vocabulary: {len(words)} word forms', file=sys.stderr)
+    if not args.no_db:
+        cached = cached_phrase_words()
+        print(f'[LEMMA STORE] wordstat_cache: {len(cached)} words', file=sys.stderr)
+        words |= cached
+    for path in args.words:
+        words |= file_words(path)
+    
+    count = index.build_lemma_store(sorted(words), args.output)
+    print(f'[LEMMA STORE] {count} entries written to {args.output}', file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
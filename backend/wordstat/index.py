@@ -1,15 +1,76 @@
+import base64
+import copy
+import gzip
 import json
 import os
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 import requests
-from collections import defaultdict
+from collections import OrderedDict, defaultdict, deque
+import hashlib
+import heapq
+from array import array
 import math
-import pymorphy3
+import mmap
+import re
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextvars import ContextVar, copy_context
+from functools import lru_cache, partial
+from itertools import chain
+import numpy as np
 import psycopg2
-from psycopg2.extras import RealDictCursor
-from datetime import datetime
+from psycopg2.extras import RealDictCursor, execute_values
+from datetime import datetime, timedelta
 
-morph = pymorphy3.MorphAnalyzer()
+class StageTimer:
+    '''Длительности (сумма по вызовам) и счётчики этапов одного запроса'''
+    __slots__ = ('durations', 'counters', 'started', 'lock')
+    
+    def __init__(self):
+        self.durations = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+    
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.durations[name] += time.perf_counter() - start
+    
+    def count(self, name: str, value: int = 1):
+        with self.lock:
+            self.counters[name] += value
+    
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'total_ms': round((time.perf_counter() - self.started) * 1000, 1),
+            'stages_ms': {k: round(v * 1000, 1) for k, v in self.durations.items()},
+            'counters': dict(self.counters)
+        }
+
+_request_timer: ContextVar = ContextVar('request_timer', default=None)
+
+@contextmanager
+def timed(stage: str):
+    '''Замер этапа в таймере текущего запроса (без таймера — ничего не делает)'''
+    timer = _request_timer.get()
+    if timer is None:
+        yield
+        return
+    with timer.stage(stage):
+        yield
+
+def count_stage(name: str, value: int = 1):
+    timer = _request_timer.get()
+    if timer is not None:
+        timer.count(name, value)
 
 def check_subscription(user_id: str) -> bool:
     try:
@@ -41,33 +102,213 @@ def check_subscription(user_id: str) -> bool:
     except Exception:
         return False
 
-def lemmatize_phrase(phrase: str) -> str:
-    '''Лемматизация фразы — приводит слова к начальной форме'''
-    words = phrase.lower().split()
-    lemmas = []
+PYMORPHY_DICT_PATH = os.environ.get('PYMORPHY_DICT_PATH')
+
+_morph = None
+_morph_lock = threading.Lock()
+
+def get_morph():
+    '''
+    pymorphy3 загружается при первой лемматизации, а не при импорте:
+    OPTIONS, GET регионов и фразы из файла лемм обходятся без словарей
+    '''
+    global _morph
+    if _morph is None:
+        with _morph_lock:
+            if _morph is None:
+                start = time.perf_counter()
+                import pymorphy3
+                _morph = pymorphy3.MorphAnalyzer(path=PYMORPHY_DICT_PATH)
+                print(f'[LEMMA] pymorphy3 loaded in {(time.perf_counter() - start) * 1000:.0f} ms')
+    return _morph
+
+LEMMA_CACHE_SIZE = int(os.environ.get('LEMMA_CACHE_SIZE', '50000'))
+LEMMA_STORE_PATH = os.environ.get(
+    'LEMMA_STORE_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lemmas.tsv')
+)
+
+lemma_store_stats = {'hits': 0, 'misses': 0}
+_lemma_store = None
+
+def _open_lemma_store():
+    '''Открывает словарь лемм (отсортированный TSV) через mmap — страницы общие для всех процессов'''
+    global _lemma_store
+    if _lemma_store is None:
+        try:
+            with open(LEMMA_STORE_PATH, 'rb') as f:
+                _lemma_store = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            print(f'[LEMMA] Store loaded: {LEMMA_STORE_PATH}')
+        except (OSError, ValueError):
+            _lemma_store = False
+    return _lemma_store
+
+def lookup_lemma_store(word: str) -> Optional[str]:
+    '''Бинарный поиск словоформы в файле "словоформа<TAB>лемма", отсортированном по байтам'''
+    store = _open_lemma_store()
+    if not store:
+        return None
+    
+    target = word.encode('utf-8')
+    lo, hi = 0, len(store)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        start = store.rfind(b'\n', 0, mid) + 1
+        end = store.find(b'\n', start)
+        if end == -1:
+            end = len(store)
+        key, _, value = store[start:end].partition(b'\t')
+        if key == target:
+            lemma_store_stats['hits'] += 1
+            return value.decode('utf-8')
+        if key < target:
+            lo = end + 1
+        else:
+            hi = start
+    
+    lemma_store_stats['misses'] += 1
+    return None
+
+def build_lemma_store(words: List[str], path: str = LEMMA_STORE_PATH) -> int:
+    '''Строит файл лемм для поставки вместе с функцией (например, по словам из собранных коллекций)'''
+    entries = {}
     for word in words:
-        parsed = morph.parse(word)[0]
-        lemmas.append(parsed.normal_form)
-    return ' '.join(lemmas)
+        word = word.lower()
+        if word and '\t' not in word and '\n' not in word and word not in entries:
+            entries[word] = get_morph().parse(word)[0].normal_form
+    
+    lines = sorted(f'{w}\t{l}'.encode('utf-8') for w, l in entries.items())
+    with open(path, 'wb') as f:
+        f.write(b'\n'.join(lines))
+    return len(lines)
+
+@lru_cache(maxsize=LEMMA_CACHE_SIZE)
+def lemmatize_word(word: str) -> str:
+    '''Начальная форма слова: LRU в памяти → файл лемм → pymorphy3'''
+    lemma = lookup_lemma_store(word)
+    if lemma is None:
+        lemma = get_morph().parse(word)[0].normal_form
+    return lemma
+
+def lemma_cache_stats() -> Dict[str, int]:
+    '''Счётчики попаданий кэша лемм'''
+    info = lemmatize_word.cache_info()
+    return {
+        'lru_hits': info.hits,
+        'lru_misses': info.misses,
+        'lru_size': info.currsize,
+        'store_hits': lemma_store_stats['hits'],
+        'store_misses': lemma_store_stats['misses']
+    }
+
+COMMERCIAL_MARKERS = [
+    'купить', 'цена', 'стоимость', 'заказать', 'доставка', 
+    'недорого', 'дешево', 'магазин', 'интернет', 'сайт',
+    'продажа', 'скидка', 'акция', 'офис', 'телефон'
+]
+
+INFO_MARKERS = [
+    'как', 'что', 'где', 'когда', 'почему', 'какой',
+    'отзывы', 'рейтинг', 'лучший', 'сравнение', 'инструкция',
+    'фото', 'видео', 'статья', 'форум'
+]
+
+COMPETITOR_MARKERS = ['авито', 'циан', 'домклик', 'яндекс недвижимость', 'юла', 'из рук в руки']
+
+# Порядок категорий важен: фраза попадает в первую подходящую
+MINUS_CATEGORIES = [
+    ('free', '🆓 Бесплатно / Халява', ['бесплатно', 'бесплатный', 'даром', 'безвозмездно', 'задарма', 'free']),
+    ('diy', '🔧 Своими руками / DIY', ['своими руками', 'самостоятельно', 'сам', 'самому', 'diy', 'как сделать', 'инструкция']),
+    ('competitors', '🏢 Конкуренты / Площадки', COMPETITOR_MARKERS),
+    ('info', 'ℹ️ Информационные запросы', ['что такое', 'как выбрать', 'какой лучше', 'отличия', 'разница', 'плюсы минусы', 'советы']),
+    ('job', '💼 Работа / Вакансии', ['вакансии', 'работа', 'резюме', 'зарплата', 'требуются', 'ищу работу', 'карьера']),
+    ('education', '🎓 Обучение / Курсы', ['курсы', 'обучение', 'семинар', 'тренинг', 'вебинар', 'мастер класс', 'уроки']),
+    ('download', '📥 Скачать / Загрузить', ['скачать', 'загрузить', 'download', 'торрент', 'онлайн', 'смотреть']),
+    ('porn', '🔞 Взрослый контент', ['порно', 'секс', 'xxx', 'эротика', 'интим']),
+    ('other', '❓ Прочие нецелевые', ['игра', 'игры', 'мультфильм', 'картинки', 'рисунок', 'раскраска', 'шутки', 'анекдоты'])
+]
+
+class MarkerAutomaton:
+    '''
+    Автомат Ахо-Корасик: находит все вхождения набора подстрок за один
+    проход по тексту. Каждому шаблону сопоставлена метка
+    '''
+    __slots__ = ('goto', 'fail', 'output')
+    
+    def __init__(self, patterns: List[tuple]):
+        self.goto = [{}]
+        self.output = [[]]
+        for pattern, label in patterns:
+            node = 0
+            for ch in pattern:
+                nxt = self.goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[node][ch] = nxt
+                    self.goto.append({})
+                    self.output.append([])
+                node = nxt
+            self.output[node].append(label)
+        
+        self.fail = [0] * len(self.goto)
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self.goto[node].items():
+                queue.append(nxt)
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.output[nxt] = self.output[nxt] + self.output[self.fail[nxt]]
+    
+    def scan(self, text: str) -> set:
+        '''Множество меток всех шаблонов, встречающихся в тексте'''
+        goto, fail, output = self.goto, self.fail, self.output
+        found = set()
+        node = 0
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if output[node]:
+                found.update(output[node])
+        return found
+
+marker_automaton = MarkerAutomaton(
+    [(m, ('commercial', m)) for m in COMMERCIAL_MARKERS] +
+    [(m, ('info', m)) for m in INFO_MARKERS] +
+    [(m, ('competitor', None)) for m in COMPETITOR_MARKERS] +
+    [(kw, ('minus', rank)) for rank, (_, _, keywords) in enumerate(MINUS_CATEGORIES) for kw in keywords]
+)
+
+@lru_cache(maxsize=100000)
+def label_phrase(phrase_lower: str) -> tuple:
+    '''
+    Разметка фразы за один проход автомата
+    Returns: (число коммерческих маркеров, число информационных маркеров,
+              номер минус-категории или None, есть ли конкурент)
+    '''
+    commercial = info = 0
+    minus_rank = None
+    competitor = False
+    for kind, value in marker_automaton.scan(phrase_lower):
+        if kind == 'commercial':
+            commercial += 1
+        elif kind == 'info':
+            info += 1
+        elif kind == 'competitor':
+            competitor = True
+        elif minus_rank is None or value < minus_rank:
+            minus_rank = value
+    return commercial, info, minus_rank, competitor
 
 def detect_intent(phrase: str) -> str:
     '''Определяет коммерческий или информационный intent'''
-    commercial_markers = [
-        'купить', 'цена', 'стоимость', 'заказать', 'доставка', 
-        'недорого', 'дешево', 'магазин', 'интернет', 'сайт',
-        'продажа', 'скидка', 'акция', 'офис', 'телефон'
-    ]
-    
-    info_markers = [
-        'как', 'что', 'где', 'когда', 'почему', 'какой',
-        'отзывы', 'рейтинг', 'лучший', 'сравнение', 'инструкция',
-        'фото', 'видео', 'статья', 'форум'
-    ]
-    
-    phrase_lower = phrase.lower()
-    
-    commercial_score = sum(1 for marker in commercial_markers if marker in phrase_lower)
-    info_score = sum(1 for marker in info_markers if marker in phrase_lower)
+    return detect_intent_lowered(phrase.lower())
+
+def detect_intent_lowered(phrase_lower: str) -> str:
+    commercial_score, info_score, _, _ = label_phrase(phrase_lower)
     
     if commercial_score > info_score:
         return 'commercial'
@@ -76,96 +317,46 @@ def detect_intent(phrase: str) -> str:
     else:
         return 'general'
 
-def detect_minus_words(phrases: List[Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
+def detect_minus_words(phrases: List[Dict[str, Any]], table: Optional['PhraseTable'] = None) -> Dict[str, List[Dict[str, Any]]]:
     '''
     Автоматическое определение минус-слов для контекстной рекламы
     Возвращает категоризированный список нецелевых запросов
     '''
-    minus_categories = {
-        'free': {
-            'name': '🆓 Бесплатно / Халява',
-            'keywords': ['бесплатно', 'бесплатный', 'даром', 'безвозмездно', 'задарма', 'free'],
-            'phrases': []
-        },
-        'diy': {
-            'name': '🔧 Своими руками / DIY',
-            'keywords': ['своими руками', 'самостоятельно', 'сам', 'самому', 'diy', 'как сделать', 'инструкция'],
-            'phrases': []
-        },
-        'competitors': {
-            'name': '🏢 Конкуренты / Площадки',
-            'keywords': ['авито', 'циан', 'домклик', 'яндекс недвижимость', 'юла', 'из рук в руки'],
-            'phrases': []
-        },
-        'info': {
-            'name': 'ℹ️ Информационные запросы',
-            'keywords': ['что такое', 'как выбрать', 'какой лучше', 'отличия', 'разница', 'плюсы минусы', 'советы'],
-            'phrases': []
-        },
-        'job': {
-            'name': '💼 Работа / Вакансии',
-            'keywords': ['вакансии', 'работа', 'резюме', 'зарплата', 'требуются', 'ищу работу', 'карьера'],
-            'phrases': []
-        },
-        'education': {
-            'name': '🎓 Обучение / Курсы',
-            'keywords': ['курсы', 'обучение', 'семинар', 'тренинг', 'вебинар', 'мастер класс', 'уроки'],
-            'phrases': []
-        },
-        'download': {
-            'name': '📥 Скачать / Загрузить',
-            'keywords': ['скачать', 'загрузить', 'download', 'торрент', 'онлайн', 'смотреть'],
-            'phrases': []
-        },
-        'porn': {
-            'name': '🔞 Взрослый контент',
-            'keywords': ['порно', 'секс', 'xxx', 'эротика', 'интим'],
-            'phrases': []
-        },
-        'other': {
-            'name': '❓ Прочие нецелевые',
-            'keywords': ['игра', 'игры', 'мультфильм', 'картинки', 'рисунок', 'раскраска', 'шутки', 'анекдоты'],
-            'phrases': []
-        }
-    }
+    category_phrases = [[] for _ in MINUS_CATEGORIES]
+    lowered = table.lowered if table is not None else [p['phrase'].lower() for p in phrases]
     
-    for phrase_data in phrases:
-        phrase_lower = phrase_data['phrase'].lower()
-        
-        matched = False
-        for category_key, category_data in minus_categories.items():
-            for keyword in category_data['keywords']:
-                if keyword in phrase_lower:
-                    category_data['phrases'].append(phrase_data)
-                    matched = True
-                    break
-            if matched:
-                break
+    with timed('minus_words'):
+        for phrase_data, phrase_lower in zip(phrases, lowered):
+            minus_rank = label_phrase(phrase_lower)[2]
+            if minus_rank is not None:
+                category_phrases[minus_rank].append(phrase_data)
     
     result = {}
-    for key, data in minus_categories.items():
-        if len(data['phrases']) > 0:
+    for (key, name, _), matched in zip(MINUS_CATEGORIES, category_phrases):
+        if len(matched) > 0:
+            stats = ClusterStats.of_phrases(matched)
             result[key] = {
-                'name': data['name'],
-                'count': len(data['phrases']),
-                'total_volume': sum(p['count'] for p in data['phrases']),
-                'phrases': sorted(data['phrases'], key=lambda x: x['count'], reverse=True)
+                'name': name,
+                'count': stats.size,
+                'total_volume': stats.total,
+                'phrases': sorted(matched, key=lambda x: x['count'], reverse=True)
             }
     
     return result
 
+TFIDF_STOP_WORDS = {
+    'в', 'на', 'с', 'по', 'для', 'из', 'и', 'или', 'как', 'что', 'за',
+    'это', 'то', 'так', 'но', 'а', 'о', 'у', 'от', 'к', 'до', 'при',
+    'без', 'под', 'над', 'между', 'перед', 'через', 'после'
+}
+
+def tokenize_for_tfidf(phrase: str) -> List[str]:
+    '''Значимые слова фразы для TF-IDF (без стоп-слов и коротких слов)'''
+    return [w for w in phrase.lower().split() if w not in TFIDF_STOP_WORDS and len(w) > 2]
+
 def calculate_tfidf(phrases: List[str]) -> List[Dict[str, float]]:
     '''Упрощенная TF-IDF без scikit-learn'''
-    stop_words = {
-        'в', 'на', 'с', 'по', 'для', 'из', 'и', 'или', 'как', 'что', 'за',
-        'это', 'то', 'так', 'но', 'а', 'о', 'у', 'от', 'к', 'до', 'при',
-        'без', 'под', 'над', 'между', 'перед', 'через', 'после'
-    }
-    
-    doc_words = []
-    for phrase in phrases:
-        words = [w for w in phrase.lower().split() if w not in stop_words and len(w) > 2]
-        doc_words.append(words)
+    doc_words = [tokenize_for_tfidf(phrase) for phrase in phrases]
     
     word_doc_count = defaultdict(int)
     for words in doc_words:
@@ -191,27 +382,746 @@ def calculate_tfidf(phrases: List[str]) -> List[Dict[str, float]]:
     
     return tfidf_vectors
 
-def cosine_similarity_simple(vec1: Dict[str, float], vec2: Dict[str, float]) -> float:
-    '''Косинусная близость между двумя векторами'''
-    all_words = set(vec1.keys()) | set(vec2.keys())
+class PhraseTable:
+    '''
+    Компактная таблица фраз: каждая фраза приводится к нижнему регистру и
+    токенизируется один раз, токены интернируются в id и лежат плоскими
+    колонками array (смещения как в CSR), частотности — в array.
+    Записи (исходные dict'ы) не копируются — в JSON уходят они же
+    '''
+    __slots__ = ('records', 'lowered', 'counts', 'offsets', 'token_ids',
+                 'tokens', 'token_index', 'lemmas', '_lemma_ids')
+    
+    def __init__(self, records: List[Dict[str, Any]]):
+        self.records = records
+        self.lowered = []
+        self.counts = array('q')
+        self.offsets = array('q', [0])
+        self.token_ids = array('i')
+        self.tokens = []
+        self.token_index = {}
+        self.lemmas = None
+        self._lemma_ids = None
+        
+        for record in records:
+            phrase_lower = record['phrase'].lower()
+            self.lowered.append(phrase_lower)
+            self.counts.append(record.get('count', 0))
+            for word in phrase_lower.split():
+                token = self.token_index.get(word)
+                if token is None:
+                    token = self.token_index[word] = len(self.tokens)
+                    self.tokens.append(word)
+                self.token_ids.append(token)
+            self.offsets.append(len(self.token_ids))
+    
+    @classmethod
+    def from_texts(cls, texts: List[str]) -> 'PhraseTable':
+        return cls([{'phrase': text, 'count': 0} for text in texts])
+    
+    def __len__(self) -> int:
+        return len(self.records)
+    
+    def word_ids(self, i: int):
+        return self.token_ids[self.offsets[i]:self.offsets[i + 1]]
+    
+    def word_count(self, i: int) -> int:
+        return self.offsets[i + 1] - self.offsets[i]
+    
+    def lemma_ids(self) -> array:
+        '''id леммы (в self.lemmas) для каждого id токена; каждое слово лемматизируется один раз'''
+        if self._lemma_ids is None:
+            self.lemmas = []
+            index = {}
+            self._lemma_ids = array('i')
+            for word in self.tokens:
+                lemma = lemmatize_word(word)
+                lemma_id = index.get(lemma)
+                if lemma_id is None:
+                    lemma_id = index[lemma] = len(self.lemmas)
+                    self.lemmas.append(lemma)
+                self._lemma_ids.append(lemma_id)
+        return self._lemma_ids
+    
+    def sorted_by_count(self, indices: List[int]) -> List[Dict[str, Any]]:
+        '''Записи по убыванию частотности (порядок равных сохраняется, как у sorted)'''
+        counts = self.counts
+        return [self.records[i] for i in sorted(indices, key=counts.__getitem__, reverse=True)]
+
+class ClusterStats:
+    '''
+    Статистика группы фраз за один проход: сумма, максимум и минимум
+    частотности, число фраз и слов. Для кластеров и минус-категорий
+    '''
+    __slots__ = ('total', 'size', 'words', 'max', 'min')
+    
+    def __init__(self):
+        self.total = 0
+        self.size = 0
+        self.words = 0
+        self.max = 0
+        self.min = 0
+    
+    def add(self, count: int, word_count: int):
+        if self.size == 0:
+            self.max = self.min = count
+        elif count > self.max:
+            self.max = count
+        elif count < self.min:
+            self.min = count
+        self.total += count
+        self.size += 1
+        self.words += word_count
+    
+    @classmethod
+    def of_phrases(cls, phrases: List[Dict[str, Any]]) -> 'ClusterStats':
+        stats = cls()
+        for p in phrases:
+            stats.add(p.get('count', 0), len(p['phrase'].split()))
+        return stats
+    
+    @classmethod
+    def of_table(cls, table: PhraseTable, indices) -> 'ClusterStats':
+        stats = cls()
+        counts = table.counts
+        offsets = table.offsets
+        for i in indices:
+            stats.add(counts[i], offsets[i + 1] - offsets[i])
+        return stats
+    
+    @property
+    def avg_words(self) -> float:
+        return round(self.words / self.size, 1) if self.size else 0
+    
+    def cluster_fields(self) -> Dict[str, Any]:
+        return {
+            'total_count': self.total,
+            'phrases_count': self.size,
+            'avg_words': self.avg_words,
+            'max_frequency': self.max,
+            'min_frequency': self.min
+        }
+
+def build_cluster(name: str, intent: str, phrases: List[Dict[str, Any]], stats: Optional[ClusterStats] = None) -> Dict[str, Any]:
+    '''Кластер в формате ответа; phrases должны быть уже отсортированы по частотности'''
+    stats = stats or ClusterStats.of_phrases(phrases)
+    return {'cluster_name': name, **stats.cluster_fields(), 'intent': intent, 'phrases': phrases}
+
+class TfidfMatrix:
+    '''
+    Разреженная TF-IDF матрица в формате CSR (NumPy)
+    Строки нормированы по L2, поэтому косинусная близость — это просто
+    скалярное произведение. Дополнительно хранится транспонированная
+    матрица (CSC), чтобы считать близость строки ко всем фразам сразу
+    '''
+    __slots__ = ('vocabulary', 'indptr', 'indices', 'data',
+                 'col_indptr', 'col_rows', 'col_data', 'n_rows')
+    
+    def __init__(self, vocabulary: Dict[str, int], indptr, indices, data):
+        self.vocabulary = vocabulary
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.n_rows = len(indptr) - 1
+        
+        order = np.argsort(indices, kind='stable')
+        row_ids = np.repeat(np.arange(self.n_rows, dtype=np.int32), np.diff(indptr))
+        self.col_rows = row_ids[order]
+        self.col_data = data[order]
+        self.col_indptr = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(indices, minlength=len(vocabulary)), out=self.col_indptr[1:])
+    
+    def row(self, i: int) -> tuple:
+        start, end = self.indptr[i], self.indptr[i + 1]
+        return self.indices[start:end], self.data[start:end]
+    
+    def similarity_row(self, i: int):
+        '''
+        Косинусная близость фразы i ко всем фразам (плотный вектор длины n)
+        Термы строки обходятся по возрастанию столбца: общие термы двух фраз
+        складываются в одном порядке, и sim(a, b) == sim(b, a) до бита
+        '''
+        terms, weights = self.row(i)
+        if len(terms) == 0:
+            return np.zeros(self.n_rows)
+        
+        rows = []
+        values = []
+        order = np.argsort(terms)
+        for term, weight in zip(terms[order], weights[order]):
+            start, end = self.col_indptr[term], self.col_indptr[term + 1]
+            rows.append(self.col_rows[start:end])
+            values.append(self.col_data[start:end] * weight)
+        
+        return np.bincount(np.concatenate(rows), weights=np.concatenate(values), minlength=self.n_rows)
+
+def build_tfidf_matrix(phrases: List[str]) -> TfidfMatrix:
+    '''Векторизация списка строк (см. build_tfidf_from_table)'''
+    return build_tfidf_from_table(PhraseTable.from_texts(phrases))
+
+def build_tfidf_from_table(table: PhraseTable, use_lemmas: bool = False, idf_blend: float = 0.0) -> TfidfMatrix:
+    '''
+    Векторизация фраз в разреженную TF-IDF матрицу
+    Веса совпадают с calculate_tfidf, но хранятся в плоских массивах
+    по словарю, а память растёт с числом ненулевых элементов, а не со словарём.
+    Термы — id токенов таблицы (или их лемм), поэтому всё считается
+    векторно по колонкам таблицы. Столбцы нумеруются в порядке первого
+    появления терма, термы в строке — в порядке появления во фразе.
+    idf_blend > 0 подмешивает глобальный IDF лемм (см. blend_global_idf)
+    '''
+    n_docs = len(table)
+    if use_lemmas:
+        term_of_token = np.frombuffer(table.lemma_ids(), dtype=np.intc)
+        names = table.lemmas
+    else:
+        term_of_token = np.arange(len(table.tokens))
+        names = table.tokens
+    keep = np.array([name not in TFIDF_STOP_WORDS and len(name) > 2 for name in names], dtype=bool)
+    
+    offsets = np.frombuffer(table.offsets, dtype=np.int64)
+    terms = term_of_token[np.frombuffer(table.token_ids, dtype=np.intc)]
+    rows = np.repeat(np.arange(n_docs, dtype=np.int64), np.diff(offsets))
+    significant = keep[terms] if len(terms) else np.zeros(0, dtype=bool)
+    terms = terms[significant]
+    rows = rows[significant]
+    
+    if len(terms) == 0:
+        return TfidfMatrix({}, np.zeros(n_docs + 1, dtype=np.int64),
+                           np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float64))
+    
+    unique_terms, first_seen = np.unique(terms, return_index=True)
+    ordered_terms = unique_terms[np.argsort(first_seen, kind='stable')]
+    column_of_term = np.zeros(len(names), dtype=np.int64)
+    column_of_term[ordered_terms] = np.arange(len(ordered_terms))
+    vocabulary = {names[term]: column for column, term in enumerate(ordered_terms.tolist())}
+    n_cols = len(vocabulary)
+    
+    # Пары (фраза, терм) с числом вхождений, в порядке первого появления
+    row_length = np.bincount(rows, minlength=n_docs)
+    keys, first_pos, term_count = np.unique(rows * n_cols + column_of_term[terms], return_index=True, return_counts=True)
+    order = np.argsort(first_pos, kind='stable')
+    keys = keys[order]
+    term_count = term_count[order]
+    pair_rows = keys // n_cols
+    pair_cols = keys % n_cols
+    
+    doc_freq = np.bincount(pair_cols, minlength=n_cols)
+    idf = np.log(n_docs / np.maximum(doc_freq, 1))
+    if idf_blend > 0:
+        idf = blend_global_idf(idf, table, ordered_terms, use_lemmas, idf_blend)
+    
+    pair_idf = idf[pair_cols]
+    weights = term_count / row_length[pair_rows] * pair_idf
+    nonzero = pair_idf > 0
+    pair_rows = pair_rows[nonzero]
+    pair_cols = pair_cols[nonzero]
+    weights = weights[nonzero]
+    
+    indptr = np.zeros(n_docs + 1, dtype=np.int64)
+    np.cumsum(np.bincount(pair_rows, minlength=n_docs), out=indptr[1:])
+    
+    # Норма строки через np.dot, как раньше: иначе веса расходятся в последнем
+    # бите и при равных близостях слияния в smart_clusterize идут в другом порядке
+    row_norms = np.array([math.sqrt(float(np.dot(w, w))) for w in np.split(weights, indptr[1:-1])])
+    
+    return TfidfMatrix(
+        vocabulary,
+        indptr,
+        pair_cols.astype(np.int32),
+        weights / np.repeat(row_norms, np.diff(indptr))
+    )
+
+def popcount_and(words, mask: int):
+    '''popcount(words & mask) для массива uint64 (np.bitwise_count — с NumPy 2.0)'''
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words & np.uint64(mask))
+    # В маске фразы всего несколько единиц — проверяем их по одной
+    shared = np.zeros(len(words), dtype=np.uint8)
+    while mask:
+        low = mask & -mask
+        shared += (words & np.uint64(low)) != 0
+        mask ^= low
+    return shared
+
+class JaccardBitsets:
+    '''
+    Множества лемм фраз (без стоп-слов и коротких слов, как в TF-IDF) —
+    битовые строки uint64 по словарю лемм запроса (bits[слово, фраза]).
+    Близость — Jaccard |A ∩ B| / |A ∪ B|: пересечение — popcount(A & B)
+    только по словам uint64, где у фразы есть биты, и только для фраз
+    с общими леммами (инвертированный индекс). Для коротких фраз (2–5 слов)
+    это почти то же, что косинус TF-IDF, но без весов и нормировки.
+    Интерфейс как у TfidfMatrix (n_rows, similarity_row), поэтому подходит
+    жадной группировке и слиянию центров
+    '''
+    __slots__ = ('bits', 'sizes', 'row_indptr', 'row_columns', 'word_indptr', 'word_ids',
+                 'col_indptr', 'col_rows', 'n_rows')
+    
+    def __init__(self, table: PhraseTable):
+        lemma_ids = np.frombuffer(table.lemma_ids(), dtype=np.int32)
+        keep = np.array([lemma not in TFIDF_STOP_WORDS and len(lemma) > 2 for lemma in table.lemmas], dtype=bool)
+        columns = np.cumsum(keep) - 1
+        n_columns = max(int(keep.sum()), 1)
+        n_words = (n_columns + 63) // 64
+        
+        self.n_rows = len(table)
+        pair_lemmas = lemma_ids[np.frombuffer(table.token_ids, dtype=np.int32)]
+        pair_rows = np.repeat(np.arange(self.n_rows, dtype=np.int64), np.diff(np.frombuffer(table.offsets, dtype=np.int64)))
+        kept = keep[pair_lemmas]
+        
+        # Повтор леммы во фразе — тот же бит; пары (фраза, лемма) по возрастанию
+        keys = np.sort(pair_rows[kept] * n_columns + columns[pair_lemmas[kept]])
+        keys = keys[np.concatenate(([True], keys[1:] != keys[:-1]))] if len(keys) else keys
+        pair_rows = keys // n_columns
+        pair_cols = keys % n_columns
+        
+        # Слово uint64 — строка, чтобы биты кандидатов брались одним take
+        self.bits = np.zeros((n_words, self.n_rows), dtype=np.uint64)
+        shifts = (pair_cols & 63).astype(np.uint64)
+        np.bitwise_or.at(self.bits, (pair_cols >> 6, pair_rows), np.left_shift(np.uint64(1), shifts))
+        self.sizes = np.bincount(pair_rows, minlength=self.n_rows)
+        self.row_indptr = np.zeros(self.n_rows + 1, dtype=np.int64)
+        np.cumsum(self.sizes, out=self.row_indptr[1:])
+        self.row_columns = pair_cols
+        
+        # Слова uint64, в которых у фразы есть биты (CSR)
+        word_keys = pair_rows * n_words + (pair_cols >> 6)
+        word_keys = word_keys[np.concatenate(([True], word_keys[1:] != word_keys[:-1]))] if len(word_keys) else word_keys
+        self.word_ids = word_keys % n_words
+        self.word_indptr = np.zeros(self.n_rows + 1, dtype=np.int64)
+        np.cumsum(np.bincount(word_keys // n_words, minlength=self.n_rows), out=self.word_indptr[1:])
+        
+        order = np.argsort(pair_cols, kind='stable')
+        self.col_rows = pair_rows[order]
+        self.col_indptr = np.zeros(n_columns + 1, dtype=np.int64)
+        np.cumsum(np.bincount(pair_cols, minlength=n_columns), out=self.col_indptr[1:])
+    
+    def similarity_row(self, i: int):
+        '''Jaccard фразы i ко всем фразам (плотный вектор длины n)'''
+        similarities = np.zeros(self.n_rows)
+        columns = self.row_columns[self.row_indptr[i]:self.row_indptr[i + 1]]
+        if len(columns) == 0:
+            return similarities
+        
+        # Фраза может попасть в кандидаты несколько раз — значение одно и то же
+        candidates = np.concatenate([self.col_rows[self.col_indptr[c]:self.col_indptr[c + 1]] for c in columns.tolist()])
+        shared = 0
+        for word in self.word_ids[self.word_indptr[i]:self.word_indptr[i + 1]].tolist():
+            shared = shared + popcount_and(self.bits[word].take(candidates), int(self.bits[word, i]))
+        similarities[candidates] = shared / (self.sizes[candidates] + self.sizes[i] - shared)
+        return similarities
+
+GLOBAL_IDF_TTL = int(os.environ.get('GLOBAL_IDF_TTL', '3600'))
+
+class GlobalIdf:
+    '''
+    Документные частоты лемм по всем выгрузкам Wordstat (global_lemma_df),
+    загруженные в массив только для чтения; живут на тёплом инстансе до expires_at
+    '''
+    __slots__ = ('index', 'doc_freq', 'documents', 'expires_at')
+    
+    def __init__(self, lemmas: List[str], doc_freq: List[int], documents: int, ttl: int):
+        self.index = {lemma: i for i, lemma in enumerate(lemmas)}
+        self.doc_freq = np.array(doc_freq, dtype=np.int64)
+        self.doc_freq.flags.writeable = False
+        self.documents = documents
+        self.expires_at = time.time() + ttl
+    
+    def idf(self, lemmas: List[str]) -> tuple:
+        '''Глобальный IDF лемм и маска лемм, которые есть в статистике'''
+        positions = np.array([self.index.get(lemma, -1) for lemma in lemmas], dtype=np.int64)
+        known = positions >= 0
+        doc_freq = np.zeros(len(lemmas), dtype=np.int64)
+        doc_freq[known] = self.doc_freq[positions[known]]
+        return np.log((self.documents + 1) / (doc_freq + 1)), known
+
+_global_idf = None
+_global_idf_lock = threading.Lock()
+
+def load_global_idf() -> GlobalIdf:
+    '''Глобальный IDF из Postgres: один раз на инстанс и заново раз в GLOBAL_IDF_TTL'''
+    global _global_idf
+    current = _global_idf
+    if current is not None and current.expires_at > time.time():
+        return current
+    
+    with _global_idf_lock:
+        if _global_idf is not None and _global_idf.expires_at > time.time():
+            return _global_idf
+        try:
+            start = time.perf_counter()
+            dsn = os.environ.get('DATABASE_URL')
+            conn = psycopg2.connect(dsn)
+            cur = conn.cursor()
+            cur.execute("SELECT documents FROM global_idf_totals WHERE id = 1")
+            totals = cur.fetchone()
+            cur.execute("SELECT lemma, doc_freq FROM global_lemma_df")
+            rows = cur.fetchall()
+            cur.close()
+            conn.close()
+            _global_idf = GlobalIdf([r[0] for r in rows], [r[1] for r in rows], totals[0] if totals else 0, GLOBAL_IDF_TTL)
+            print(f'[GLOBAL IDF] Loaded {len(rows)} lemmas over {_global_idf.documents} phrases in {(time.perf_counter() - start) * 1000:.0f} ms')
+        except Exception as e:
+            print(f'[GLOBAL IDF] Load error: {e}')
+            # Пустая статистика (смешивание ничего не меняет) до следующей попытки через минуту
+            _global_idf = GlobalIdf([], [], 0, 60)
+        return _global_idf
+
+def blend_global_idf(local_idf, table: PhraseTable, terms, use_lemmas: bool, blend: float):
+    '''
+    (1 - blend) · IDF запроса + blend · глобальный IDF для термов, лемма которых
+    есть в глобальной статистике; остальные термы — только IDF запроса
+    '''
+    global_idf = load_global_idf()
+    if global_idf.documents == 0:
+        return local_idf
     
-    dot_product = sum(vec1.get(w, 0) * vec2.get(w, 0) for w in all_words)
+    if use_lemmas:
+        lemmas = [table.lemmas[term] for term in terms.tolist()]
+    else:
+        lemma_ids = table.lemma_ids()
+        lemmas = [table.lemmas[lemma_ids[term]] for term in terms.tolist()]
+    global_values, known = global_idf.idf(lemmas)
+    return np.where(known, (1 - blend) * local_idf + blend * global_values, local_idf)
+
+GLOBAL_IDF_FLUSH_SIZE = int(os.environ.get('GLOBAL_IDF_FLUSH_SIZE', '5000'))
+# Пока база недоступна, буфер растёт не дальше этого — старые фразы отбрасываются
+GLOBAL_IDF_BUFFER_LIMIT = GLOBAL_IDF_FLUSH_SIZE * 10
+
+_pending_idf_phrases = []
+_pending_idf_lock = threading.Lock()
+
+def record_idf_phrases(phrases: List[str]):
+    '''Фразы свежей выгрузки Wordstat — в буфер для пакетного обновления глобальных частот'''
+    with _pending_idf_lock:
+        _pending_idf_phrases.extend(phrases)
+
+def flush_global_idf_if_due():
+    '''flush_global_idf, когда в буфере набралось GLOBAL_IDF_FLUSH_SIZE фраз — один upsert на несколько запросов'''
+    with _pending_idf_lock:
+        due = len(_pending_idf_phrases) >= GLOBAL_IDF_FLUSH_SIZE
+    if due:
+        flush_global_idf()
+
+def flush_global_idf():
+    '''
+    Документные частоты лемм из буфера одним пакетным upsert.
+    Если upsert не прошёл, фразы возвращаются в буфер до следующего flush
+    '''
+    with _pending_idf_lock:
+        phrases = list(_pending_idf_phrases)
+        _pending_idf_phrases.clear()
+    if not phrases:
+        return
     
-    norm1 = math.sqrt(sum(v**2 for v in vec1.values()))
-    norm2 = math.sqrt(sum(v**2 for v in vec2.values()))
+    doc_freq = defaultdict(int)
+    for phrase in phrases:
+        for lemma in {lemmatize_word(word) for word in phrase.lower().split()}:
+            if lemma not in TFIDF_STOP_WORDS and len(lemma) > 2:
+                doc_freq[lemma] += 1
     
-    if norm1 == 0 or norm2 == 0:
-        return 0.0
+    committed = False
+    try:
+        dsn = os.environ.get('DATABASE_URL')
+        conn = psycopg2.connect(dsn)
+        cur = conn.cursor()
+        # Строки в одном порядке у всех инстансов — параллельные upsert не ловят взаимоблокировку
+        execute_values(
+            cur,
+            """INSERT INTO global_lemma_df (lemma, doc_freq) VALUES %s
+               ON CONFLICT (lemma) DO UPDATE SET
+                   doc_freq = global_lemma_df.doc_freq + EXCLUDED.doc_freq,
+                   updated_at = CURRENT_TIMESTAMP""",
+            sorted(doc_freq.items()),
+            page_size=1000
+        )
+        cur.execute(
+            """INSERT INTO global_idf_totals (id, documents) VALUES (1, %s)
+               ON CONFLICT (id) DO UPDATE SET
+                   documents = global_idf_totals.documents + EXCLUDED.documents,
+                   updated_at = CURRENT_TIMESTAMP""",
+            (len(phrases),)
+        )
+        conn.commit()
+        committed = True
+        cur.close()
+        conn.close()
+        print(f'[GLOBAL IDF] Upserted {len(doc_freq)} lemmas from {len(phrases)} phrases')
+    except Exception as e:
+        print(f'[GLOBAL IDF] Flush error: {e}')
+        if committed:
+            return
+        print(f'[GLOBAL IDF] {len(phrases)} phrases kept for retry')
+        with _pending_idf_lock:
+            _pending_idf_phrases[:0] = phrases
+            del _pending_idf_phrases[:-GLOBAL_IDF_BUFFER_LIMIT]
+
+MINHASH_PERMUTATIONS = 32
+MINHASH_BANDS = 8
+MINHASH_PRIME = 4294967311
+NEAR_DUPLICATE_THRESHOLD = 0.8
+
+_minhash_rng = np.random.default_rng(20240601)
+_minhash_a = _minhash_rng.integers(1, 2**31 - 1, size=MINHASH_PERMUTATIONS, dtype=np.int64)
+_minhash_b = _minhash_rng.integers(0, 2**31 - 1, size=MINHASH_PERMUTATIONS, dtype=np.int64)
+
+def collapse_near_duplicates(phrases: List[Dict[str, Any]], threshold: float = NEAR_DUPLICATE_THRESHOLD) -> tuple:
+    '''
+    Схлопывание почти одинаковых фраз (перестановки слов, предлоги, словоформы)
+    через MinHash + LSH. Кандидаты из общих LSH-корзин проверяются точным
+    коэффициентом Жаккара по множествам лемм — с представителем группы, а не
+    по цепочке, поэтому каждая фраза группы близка к представителю.
+    Фразы с минус-словами и конкурентами не схлопываются никогда:
+    минус-категории и кластер конкурентов видят их как есть
+    Returns: (representatives, members) — представитель каждой группы
+             (самая частотная фраза с суммарной частотностью) и словарь
+             фраза представителя → исходные фразы группы
+    '''
+    # Шинглы — множества id лемм из таблицы фраз (каждое слово лемматизируется один раз);
+    # у размеченных фраз шинглов нет, и в LSH они не попадают
+    table = PhraseTable(phrases)
+    lemma_ids = table.lemma_ids()
+    significant = [token not in TFIDF_STOP_WORDS for token in table.tokens]
+    shingles = []
+    for i in range(len(table)):
+        _, _, minus_rank, competitor = label_phrase(table.lowered[i])
+        if minus_rank is not None or competitor:
+            shingles.append(frozenset())
+        else:
+            shingles.append(frozenset(lemma_ids[t] for t in table.word_ids(i) if significant[t]))
     
-    return dot_product / (norm1 * norm2)
+    flat_ids = []
+    offsets = []
+    rows = []
+    for idx, lemma_set in enumerate(shingles):
+        if not lemma_set:
+            continue
+        offsets.append(len(flat_ids))
+        rows.append(idx)
+        flat_ids.extend(lemma_set)
+    
+    candidates = defaultdict(set)
+    if rows:
+        token_hashes = np.array([zlib.crc32(lemma.encode('utf-8')) for lemma in table.lemmas], dtype=np.int64)
+        permuted = (token_hashes[:, None] * _minhash_a + _minhash_b) % MINHASH_PRIME
+        signatures = np.minimum.reduceat(permuted[np.array(flat_ids)], np.array(offsets), axis=0)
+        
+        rows_per_band = MINHASH_PERMUTATIONS // MINHASH_BANDS
+        for band in range(MINHASH_BANDS):
+            buckets = defaultdict(list)
+            band_sigs = signatures[:, band * rows_per_band:(band + 1) * rows_per_band]
+            for row, sig in zip(rows, map(bytes, band_sigs)):
+                buckets[sig].append(row)
+            
+            for bucket in buckets.values():
+                if len(bucket) > 1:
+                    for row in bucket:
+                        candidates[row].update(bucket)
+    
+    # Представитель — самая частотная фраза группы (при равенстве — первая):
+    # фразы обходятся по убыванию частотности, свободная фраза становится
+    # представителем и забирает свободных кандидатов, близких именно к ней
+    counts = table.counts
+    leader = {}
+    for idx in sorted(candidates, key=lambda i: (-counts[i], i)):
+        if idx in leader:
+            continue
+        leader[idx] = idx
+        a = shingles[idx]
+        for other in sorted(candidates[idx]):
+            if other in leader:
+                continue
+            b = shingles[other]
+            if len(a & b) / len(a | b) >= threshold:
+                leader[other] = idx
+    
+    groups = defaultdict(list)
+    for idx in range(len(phrases)):
+        groups[leader.get(idx, idx)].append(idx)
+    
+    representatives = []
+    members = {}
+    for root in sorted(groups, key=lambda r: groups[r][0]):
+        group = [phrases[i] for i in groups[root]]
+        best = phrases[root]
+        if len(group) == 1:
+            representatives.append(best)
+            continue
+        rep = dict(best, count=sum(p['count'] for p in group))
+        representatives.append(rep)
+        members[rep['phrase']] = group
+    
+    return representatives, members
+
+def expand_near_duplicates(groups: List[Dict[str, Any]], members: Dict[str, List[Dict[str, Any]]]) -> None:
+    '''Разворачивает представителей обратно в исходные фразы в кластерах / минус-категориях'''
+    for group in groups:
+        expanded = []
+        for p in group['phrases']:
+            expanded.extend(members.get(p['phrase'], [p]))
+        if len(expanded) == len(group['phrases']):
+            continue
+        
+        expanded.sort(key=lambda x: x['count'], reverse=True)
+        group['phrases'] = expanded
+        if 'phrases_count' in group:
+            group.update(ClusterStats.of_phrases(expanded).cluster_fields())
+        elif 'count' in group:
+            group['count'] = len(expanded)
+
+def greedy_similarity_groups(tfidf: TfidfMatrix, threshold: float) -> List[List[int]]:
+    '''
+    Жадная группировка: очередная свободная фраза забирает все свободные фразы
+    с близостью не ниже порога. Строка близостей считается одним разреженным
+    произведением по инвертированному индексу — только с фразами, имеющими общие термы
+    (tfidf может быть и JaccardBitsets)
+    '''
+    used = np.zeros(tfidf.n_rows, dtype=bool)
+    groups = []
+    for i in range(tfidf.n_rows):
+        if used[i]:
+            continue
+        
+        used[i] = True
+        similarities = tfidf.similarity_row(i)
+        matches = np.nonzero((similarities >= threshold) & ~used)[0]
+        used[matches] = True
+        groups.append([i] + matches.tolist())
+    return groups
+
+KNN_NEIGHBORS = 1
+KNN_MAX_POSTINGS = int(os.environ.get('KNN_MAX_POSTINGS', '64'))
+KNN_BLOCK_SIZE = 2048
+KNN_BLOCK_CELLS = 1 << 21
 
-def clusterize_advanced(phrases: List[Dict[str, Any]], mode: str = 'context', region_names: List[str] = None, selected_intents: List[str] = None) -> tuple:
+def text_ranks(table: PhraseTable) -> np.ndarray:
+    '''Ранг фразы в алфавитном порядке — ключ для разрешения равенств, не зависящий от порядка фраз'''
+    ranks = np.empty(len(table), dtype=np.int64)
+    ranks[np.argsort(np.array(table.lowered), kind='stable')] = np.arange(len(table))
+    return ranks
+
+def _expand_ranges(starts, lengths) -> np.ndarray:
+    '''Конкатенация диапазонов [start, start + length)'''
+    offsets = np.cumsum(lengths) - lengths
+    return np.arange(lengths.sum()) - np.repeat(offsets, lengths) + np.repeat(starts, lengths)
+
+def knn_similarity_graph(tfidf: TfidfMatrix, ranks: np.ndarray, threshold: float,
+                         neighbors: int = KNN_NEIGHBORS, max_postings: int = KNN_MAX_POSTINGS) -> tuple:
+    '''
+    Разреженный граф k ближайших соседей по косинусу
+    Кандидаты в соседи берутся из инвертированного индекса; у частых термов
+    в нём остаются max_postings фраз с наибольшим весом, поэтому работа
+    ~ n × термы × max_postings, а не n². Близость кандидатов считается точно
+    по всем общим термам. Равенства разрешаются по ranks (тексту фразы),
+    так что граф не зависит от порядка фраз
+    Returns: (sources, targets, similarities) — рёбра к соседям с близостью не ниже порога
+    '''
+    n = tfidf.n_rows
+    n_cols = len(tfidf.col_indptr) - 1
+    
+    # Усечённые списки фраз по термам: по убыванию веса, затем по тексту
+    entry_cols = np.repeat(np.arange(n_cols), np.diff(tfidf.col_indptr))
+    order = np.lexsort((ranks[tfidf.col_rows], -tfidf.col_data, entry_cols))
+    kept = np.arange(len(order)) - tfidf.col_indptr[entry_cols] < max_postings
+    posting_rows = tfidf.col_rows[order[kept]]
+    posting_lengths = np.minimum(np.diff(tfidf.col_indptr), max_postings)
+    posting_starts = np.cumsum(posting_lengths) - posting_lengths
+    
+    # Строки блока разворачиваются в плотную матрицу block × термы, чтобы
+    # близость пары считалась выборкой по термам кандидата
+    row_lengths = np.diff(tfidf.indptr)
+    entry_rows = np.repeat(np.arange(n), row_lengths)
+    block_size = max(1, min(KNN_BLOCK_SIZE, KNN_BLOCK_CELLS // max(n_cols, 1)))
+    dense = np.zeros(block_size * n_cols)
+    
+    sources = []
+    targets = []
+    weights = []
+    for start in range(0, n, block_size):
+        end = min(n, start + block_size)
+        lo, hi = tfidf.indptr[start], tfidf.indptr[end]
+        if lo == hi:
+            continue
+        block_cols = tfidf.indices[lo:hi]
+        block_cells = (entry_rows[lo:hi] - start) * n_cols + block_cols
+        dense[block_cells] = tfidf.data[lo:hi]
+        
+        lengths = posting_lengths[block_cols]
+        src = np.repeat(entry_rows[lo:hi], lengths)
+        dst = posting_rows[_expand_ranges(posting_starts[block_cols], lengths)]
+        pairs = np.sort(src * n + dst)
+        pairs = pairs[np.concatenate(([True], pairs[1:] != pairs[:-1]))]
+        src, dst = pairs // n, pairs % n
+        distinct = src != dst
+        src, dst = src[distinct], dst[distinct]
+        
+        pair_of_entry = np.repeat(np.arange(len(src)), row_lengths[dst])
+        entries = _expand_ranges(tfidf.indptr[dst], row_lengths[dst])
+        cells = (src[pair_of_entry] - start) * n_cols + tfidf.indices[entries]
+        similarities = np.bincount(pair_of_entry, weights=dense[cells] * tfidf.data[entries], minlength=len(src))
+        dense[block_cells] = 0
+        
+        close = similarities >= threshold
+        src, dst, similarities = src[close], dst[close], similarities[close]
+        order = np.lexsort((ranks[dst], -similarities, src))
+        src, dst, similarities = src[order], dst[order], similarities[order]
+        first = np.searchsorted(src, src, side='left')
+        top = np.arange(len(src)) - first < neighbors
+        sources.append(src[top])
+        targets.append(dst[top])
+        weights.append(similarities[top])
+    
+    if not sources:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+    return np.concatenate(sources), np.concatenate(targets), np.concatenate(weights)
+
+def connected_components(n: int, sources: np.ndarray, targets: np.ndarray) -> np.ndarray:
+    '''
+    Компоненты связности (union-find векторно): корни концов каждого ребра
+    подвешиваются к меньшему, затем пути сжимаются до корня
+    Returns: метка компоненты (наименьший номер вершины) для каждой вершины
+    '''
+    labels = np.arange(n)
+    while True:
+        source_roots, target_roots = labels[sources], labels[targets]
+        if np.array_equal(source_roots, target_roots):
+            return labels
+        lowest = np.minimum(source_roots, target_roots)
+        np.minimum.at(labels, source_roots, lowest)
+        np.minimum.at(labels, target_roots, lowest)
+        while True:
+            jumped = labels[labels]
+            if np.array_equal(jumped, labels):
+                break
+            labels = jumped
+
+def knn_similarity_groups(tfidf: TfidfMatrix, ranks: np.ndarray, threshold: float) -> List[List[int]]:
+    '''
+    Группы — компоненты связности графа ближайших соседей (рёбра с близостью
+    не ниже порога). По умолчанию у фразы одно ребро — к ближайшей: короткие
+    фразы с общими частыми словами при k ≥ 2 сливаются в одну гигантскую
+    компоненту. В отличие от greedy_similarity_groups результат не зависит
+    от порядка фраз: группы и фразы в них упорядочены по ranks
+    '''
+    sources, targets, _ = knn_similarity_graph(tfidf, ranks, threshold)
+    labels = connected_components(tfidf.n_rows, sources, targets)
+    by_text = np.argsort(ranks)
+    members = by_text[np.argsort(labels[by_text], kind='stable')]
+    bounds = np.nonzero(np.diff(labels[members]))[0] + 1
+    groups = [group.tolist() for group in np.split(members, bounds)]
+    groups.sort(key=lambda group: ranks[group[0]])
+    return groups
+
+def clusterize_advanced(phrases: List[Dict[str, Any]], mode: str = 'context', region_names: List[str] = None, selected_intents: List[str] = None, algorithm: str = 'greedy', idf_blend: float = 0.0, similarity: str = 'tfidf') -> tuple:
     '''
     Продвинутая кластеризация через улучшенный TF-IDF алгоритм
     Создаёт МНОГО маленьких кластеров вместо одного большого
     Args:
         phrases: список фраз с частотностью
         mode: 'context' (Яндекс.Директ) или 'seo' (SEO)
+        algorithm: 'greedy' (жадная группировка) или 'knn' (компоненты графа соседей)
+        idf_blend: доля глобального IDF лемм в весах (0 — только IDF запроса)
+        similarity: 'tfidf' (косинус) или 'jaccard' (битовые множества лемм, только для 'greedy')
     Returns: (clusters, minus_words)
     '''
     if len(phrases) < 5:
@@ -221,7 +1131,13 @@ def clusterize_advanced(phrases: List[Dict[str, Any]], mode: str = 'context', re
     
     print(f'[ADVANCED] Starting advanced clustering for {len(phrases)} phrases, mode: {mode}')
     
-    tfidf_vectors = calculate_tfidf([p['phrase'] for p in phrases])
+    table = PhraseTable(phrases)
+    if similarity == 'jaccard' and algorithm != 'knn':
+        with timed('bitsets'):
+            vectors = JaccardBitsets(table)
+    else:
+        with timed('tfidf'):
+            vectors = build_tfidf_from_table(table, idf_blend=idf_blend)
     
     if mode == 'context':
         similarity_threshold = 0.15
@@ -230,104 +1146,62 @@ def clusterize_advanced(phrases: List[Dict[str, Any]], mode: str = 'context', re
         similarity_threshold = 0.2
         min_cluster_size = 3
     
-    used = set()
-    clusters_dict = []
-    
-    for i, phrase_a in enumerate(phrases):
-        if i in used:
-            continue
-        
-        cluster = [i]
-        used.add(i)
-        
-        for j, phrase_b in enumerate(phrases):
-            if j in used or j == i:
-                continue
-            
-            similarity = cosine_similarity_simple(tfidf_vectors[i], tfidf_vectors[j])
-            
-            if similarity >= similarity_threshold:
-                cluster.append(j)
-                used.add(j)
-        
-        if len(cluster) >= min_cluster_size:
-            clusters_dict.append([phrases[idx] for idx in cluster])
-    
-    remaining = [phrases[i] for i in range(len(phrases)) if i not in used]
-    if remaining:
-        print(f'[ADVANCED] {len(remaining)} phrases remain unclustered')
-        for phrase in remaining:
-            clusters_dict.append([phrase])
-    
-    clusters = []
-    for cluster_phrases in clusters_dict:
-        cluster_name = generate_cluster_name(cluster_phrases)
-        total_volume = sum(p['count'] for p in cluster_phrases)
-        
-        clusters.append({
-            'name': cluster_name,
-            'phrases': sorted(cluster_phrases, key=lambda x: x['count'], reverse=True),
-            'count': len(cluster_phrases),
-            'total_volume': total_volume
-        })
+    with timed('similarity'):
+        if algorithm == 'knn':
+            candidate_groups = knn_similarity_groups(vectors, text_ranks(table), similarity_threshold)
+        else:
+            candidate_groups = greedy_similarity_groups(vectors, similarity_threshold)
+        groups = [cluster for cluster in candidate_groups if len(cluster) >= min_cluster_size]
+    
+    with timed('naming'):
+        clusters = []
+        for cluster_indices in groups:
+            stats = ClusterStats.of_table(table, cluster_indices)
+            clusters.append({
+                'name': cluster_name_from_table(table, cluster_indices),
+                'phrases': table.sorted_by_count(cluster_indices),
+                'count': stats.size,
+                'total_volume': stats.total
+            })
     
     clusters.sort(key=lambda x: x['total_volume'], reverse=True)
     
-    minus_words = detect_minus_words(phrases) if mode == 'context' else {}
+    minus_words = detect_minus_words(phrases, table) if mode == 'context' else {}
     
     print(f'[ADVANCED] Created {len(clusters)} clusters (avg size: {len(phrases) / len(clusters):.1f})')
     return clusters, minus_words
 
-def generate_cluster_name(cluster_phrases: List[Dict[str, Any]]) -> str:
-    '''Генерация названия кластера на основе общих слов'''
-    stop_words = {
-        'в', 'на', 'с', 'по', 'для', 'из', 'и', 'или', 'как', 'что', 'за',
-        'это', 'то', 'так', 'но', 'а', 'о', 'у', 'от', 'к', 'до', 'при'
-    }
-    
+CLUSTER_NAME_STOP_WORDS = {
+    'в', 'на', 'с', 'по', 'для', 'из', 'и', 'или', 'как', 'что', 'за',
+    'это', 'то', 'так', 'но', 'а', 'о', 'у', 'от', 'к', 'до', 'при'
+}
+
+def cluster_name_from_table(table: PhraseTable, indices) -> str:
+    '''Название по трём самым частым значимым словам фраз indices (счёт по id токенов)'''
+    tokens = table.tokens
     word_counts = defaultdict(int)
-    for p in cluster_phrases:
-        words = [w.lower() for w in p['phrase'].split() if w.lower() not in stop_words and len(w) > 2]
-        for word in words:
-            word_counts[word] += 1
+    for i in indices:
+        for token in table.word_ids(i):
+            word = tokens[token]
+            if len(word) > 2 and word not in CLUSTER_NAME_STOP_WORDS:
+                word_counts[token] += 1
     
     if not word_counts:
         return '📂 Кластер'
     
-    top_words = sorted(word_counts.items(), key=lambda x: x[1], reverse=True)[:3]
-    name = ' '.join([w[0] for w in top_words])
+    top_words = heapq.nlargest(3, word_counts.items(), key=lambda x: x[1])
+    name = ' '.join([tokens[w[0]] for w in top_words])
     
     return f'🔹 {name.capitalize()}'
 
-def clusterize_with_openai(phrases: List[Dict[str, Any]], mode: str = 'context', region_names: List[str] = None, selected_intents: List[str] = None) -> tuple:
-    '''
-    Кластеризация через OpenAI GPT-4o с учётом регионов и интентов
-    Args:
-        phrases: список фраз с частотностью
-        mode: 'context' (Яндекс.Директ) или 'seo' (SEO)
-        region_names: список регионов (например ['Москва', 'Санкт-Петербург'])
-        selected_intents: выбранные интенты (например ['commercial', 'transactional'])
-    Returns: (clusters, minus_words)
-    '''
-    openai_key = os.environ.get('OPENAI_API_KEY')
-    if not openai_key:
-        print('[OPENAI] API key not found - using TF-IDF clustering')
-        clusters = smart_clusterize(phrases, mode)
-        minus_words = detect_minus_words(phrases) if mode == 'context' else {}
-        return clusters, minus_words
-    
-    phrases_text = '\n'.join([f"{p['phrase']} ({p['count']} показов)" for p in phrases[:150]])
-    
-    regions_text = ', '.join(region_names) if region_names else 'Россия'
-    
-    intent_descriptions = {
-        'commercial': 'Коммерческие (купить, цена, заказать)',
-        'transactional': 'Транзакционные (оформить, записаться, получить)',
-        'informational': 'Информационные (как, что такое, инструкция)',
-        'navigational': 'Навигационные (сайт, официальный, контакты)'
-    }
-    
-    selected_intents_text = ', '.join([intent_descriptions.get(i, i) for i in selected_intents]) if selected_intents else 'Все типы'
+LLM_CHUNK_SIZE = 150
+LLM_WORKERS = int(os.environ.get('LLM_WORKERS', '4'))
+LLM_BUDGET = float(os.environ.get('LLM_BUDGET', '120'))
+LLM_RACE_BUDGET = float(os.environ.get('LLM_RACE_BUDGET', '20'))
+
+def build_cluster_prompt(chunk: List[Dict[str, Any]], mode: str, regions_text: str, selected_intents_text: str) -> str:
+    '''Промпт кластеризации одного чанка (не больше LLM_CHUNK_SIZE фраз)'''
+    phrases_text = '\n'.join([f"{p['phrase']} ({p['count']} показов)" for p in chunk])
     
     if mode == 'context':
         prompt = f"""Ты эксперт по семантической кластеризации для Яндекс.Директ.
@@ -379,7 +1253,7 @@ def clusterize_with_openai(phrases: List[Dict[str, Any]], mode: str = 'context',
 
 🚨 ВАЖНО: НЕ создавай один гигантский кластер!
 Если видишь разные интенты/действия/объекты — ОБЯЗАТЕЛЬНО разделяй на отдельные кластеры.
-МИНИМУМ 3-5 кластеров для {len(phrases[:150])} фраз.
+МИНИМУМ 3-5 кластеров для {len(chunk)} фраз.
 
 **Принцип 5: Название = смысл группы**
 Название должно отражать ОБЩИЙ интент:
@@ -393,7 +1267,7 @@ def clusterize_with_openai(phrases: List[Dict[str, Any]], mode: str = 'context',
 Регионы: {regions_text}
 Интенты: {selected_intents_text}
 
-📋 ФРАЗЫ ДЛЯ КЛАСТЕРИЗАЦИИ ({len(phrases[:150])} шт):
+📋 ФРАЗЫ ДЛЯ КЛАСТЕРИЗАЦИИ ({len(chunk)} шт):
 {phrases_text}
 
 ⚡ ФОРМАТ ОТВЕТА (JSON):
@@ -411,7 +1285,7 @@ def clusterize_with_openai(phrases: List[Dict[str, Any]], mode: str = 'context',
 }}
 
 ✋ СТОП! ПЕРЕД ОТПРАВКОЙ ОТВЕТА ПРОВЕРЬ:
-1. Подсчитай фразы: в твоём JSON должно быть РОВНО {len(phrases[:150])} фраз (как в списке выше)
+1. Подсчитай фразы: в твоём JSON должно быть РОВНО {len(chunk)} фраз (как в списке выше)
 2. Открой список выше и сравни первые 3 фразы — они ИДЕНТИЧНЫ?
 3. Ты НЕ добавил ни одной фразы от себя?
 4. Ты НЕ пропустил ни одной фразы из списка?
@@ -477,7 +1351,7 @@ def clusterize_with_openai(phrases: List[Dict[str, Any]], mode: str = 'context',
 Регионы: {regions_text}
 Интенты: {selected_intents_text}
 
-📋 ФРАЗЫ ({len(phrases[:150])} шт):
+📋 ФРАЗЫ ({len(chunk)} шт):
 {phrases_text}
 
 ⚡ ОТВЕТ В JSON:
@@ -493,6 +1367,253 @@ def clusterize_with_openai(phrases: List[Dict[str, Any]], mode: str = 'context',
   ]
 }}"""
     
+    return prompt
+
+def clusterize_chunk_with_openai(chunk: List[Dict[str, Any]], mode: str, regions_text: str, selected_intents_text: str, openai_key: str, proxies: Optional[Dict[str, str]], deadline: float) -> Optional[tuple]:
+    '''
+    Map-шаг: один запрос к модели по чанку.
+    Возвращает (clusters, minus_words) или None, если модель недоступна или изменила фразы чанка
+    '''
+    prompt = build_cluster_prompt(chunk, mode, regions_text, selected_intents_text)
+    response = requests.post(
+        'https://api.openai.com/v1/chat/completions',
+        headers={
+            'Authorization': f'Bearer {openai_key}',
+            'Content-Type': 'application/json'
+        },
+        json={
+            'model': LLM_MODEL,
+            'messages': [
+                {'role': 'system', 'content': 'Ты эксперт по кластеризации запросов. Строго следуй инструкциям. Копируй фразы ТОЧНО как в списке. Отвечаешь только валидным JSON.'},
+                {'role': 'user', 'content': prompt}
+            ],
+            'temperature': 0.0,
+            'response_format': {'type': 'json_object'}
+        },
+        proxies=proxies if proxies else None,
+        timeout=max(1, min(90, deadline - time.monotonic()))
+    )
+    
+    if response.status_code != 200:
+        print(f'[OPENAI] API error {response.status_code}: {response.text}, falling back to TF-IDF')
+        return None
+    
+    data = response.json()
+    content = data['choices'][0]['message']['content']
+    result = json.loads(content)
+    clusters = result.get('clusters', [])
+    minus_words = result.get('minus_words', {})
+    
+    # ВАЛИДАЦИЯ: проверяем что OpenAI не изменил фразы чанка
+    original_phrases_set = {p['phrase'].strip().lower() for p in chunk}
+    clustered_phrases_set = set()
+    
+    for cluster in clusters:
+        for phrase_obj in cluster.get('phrases', []):
+            clustered_phrases_set.add(phrase_obj['phrase'].strip().lower())
+    
+    # Проверяем что нет лишних фраз (которых не было в оригинале)
+    added_phrases = clustered_phrases_set - original_phrases_set
+    if added_phrases:
+        print(f'[OPENAI] ❌ ERROR: AI добавил {len(added_phrases)} фраз от себя! Откат к TF-IDF')
+        print(f'[OPENAI] Примеры добавленных: {list(added_phrases)[:3]}')
+        return None
+    
+    # Проверяем что OpenAI не удалил фразы
+    deleted_phrases = original_phrases_set - clustered_phrases_set
+    if deleted_phrases:
+        print(f'[OPENAI] ❌ ERROR: AI удалил {len(deleted_phrases)} фраз! Откат к TF-IDF')
+        print(f'[OPENAI] Примеры удалённых: {list(deleted_phrases)[:5]}')
+        return None
+    
+    print(f'[OPENAI] ✅ Валидация OK: {len(clusters)} кластеров, {len(clustered_phrases_set)}/{len(original_phrases_set)} фраз')
+    return clusters, minus_words
+
+def clusterize_chunk_locally(chunk: List[Dict[str, Any]], mode: str) -> tuple:
+    clusters = smart_clusterize(chunk, mode)
+    minus_words = detect_minus_words(chunk) if mode == 'context' else {}
+    return clusters, minus_words
+
+def partition_lexical_chunks(phrases: List[Dict[str, Any]], chunk_size: int = LLM_CHUNK_SIZE, threshold: float = 0.15) -> List[List[Dict[str, Any]]]:
+    '''
+    Разбиение на чанки для map-шага: жадные TF-IDF группы упаковываются подряд,
+    группы с одинаковым ведущим термом идут рядом, поэтому похожие фразы попадают
+    в один чанк и модель видит их вместе
+    '''
+    if len(phrases) <= chunk_size:
+        return [phrases]
+    
+    tfidf = build_tfidf_matrix([p['phrase'] for p in phrases])
+    terms = [None] * len(tfidf.vocabulary)
+    for term, col in tfidf.vocabulary.items():
+        terms[col] = term
+    
+    def head_term(i: int) -> str:
+        cols, weights = tfidf.row(i)
+        return terms[cols[np.argmax(weights)]] if len(cols) else ''
+    
+    groups = greedy_similarity_groups(tfidf, threshold)
+    groups.sort(key=lambda group: (head_term(group[0]), group[0]))
+    
+    chunks = []
+    current = []
+    for group in groups:
+        members = [phrases[i] for i in group]
+        for start in range(0, len(members), chunk_size):
+            part = members[start:start + chunk_size]
+            if current and len(current) + len(part) > chunk_size:
+                chunks.append(current)
+                current = []
+            current.extend(part)
+    if current:
+        chunks.append(current)
+    return chunks
+
+def reduce_chunk_clusters(results: List[tuple]) -> tuple:
+    '''
+    Reduce-шаг: кластеры с одинаковым названием из разных чанков объединяются,
+    минус-слова сливаются по категориям
+    '''
+    merged = {}
+    merged_keys = set()
+    minus_words = {}
+    for clusters, chunk_minus in results:
+        for cluster in clusters:
+            key = ' '.join(str(cluster.get('cluster_name', '')).lower().split())
+            target = merged.get(key)
+            if target is None:
+                merged[key] = {**cluster, 'phrases': list(cluster.get('phrases', []))}
+            else:
+                target['phrases'].extend(cluster.get('phrases', []))
+                merged_keys.add(key)
+        
+        for category, value in (chunk_minus or {}).items():
+            current = minus_words.get(category)
+            if current is None:
+                minus_words[category] = {**value, 'phrases': list(value['phrases'])} if isinstance(value, dict) else list(value)
+            elif isinstance(current, dict) and isinstance(value, dict):
+                current['phrases'].extend(value['phrases'])
+                stats = ClusterStats.of_phrases(current['phrases'])
+                current['count'] = stats.size
+                current['total_volume'] = stats.total
+            elif isinstance(current, list) and isinstance(value, list):
+                current.extend(value)
+    
+    for key in merged_keys:
+        cluster = merged[key]
+        cluster_phrases = cluster['phrases']
+        cluster_phrases.sort(key=lambda x: x.get('count', 0), reverse=True)
+        cluster.update(ClusterStats.of_phrases(cluster_phrases).cluster_fields())
+    for value in minus_words.values():
+        if isinstance(value, dict):
+            value['phrases'].sort(key=lambda x: x['count'], reverse=True)
+    
+    return list(merged.values()), minus_words
+
+def normalize_llm_clusters(chunk: List[Dict[str, Any]], clusters: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    '''
+    Кластеры модели в формате build_cluster, как у чанков, ушедших в TF-IDF:
+    исходные записи фраз (частотность из Wordstat, а не из ответа) и поля ClusterStats
+    '''
+    records = {p['phrase'].strip().lower(): p for p in chunk}
+    result = []
+    for cluster in clusters:
+        cluster_phrases = [records[p['phrase'].strip().lower()] for p in cluster.get('phrases', [])]
+        if not cluster_phrases:
+            continue
+        result.append(build_cluster(
+            cluster.get('cluster_name', ''),
+            cluster.get('intent', 'general'),
+            sorted(cluster_phrases, key=lambda x: x['count'], reverse=True)
+        ))
+    return result
+
+def gather_chunk_results(chunks: List[List[Dict[str, Any]]], futures: list, mode: str) -> List[tuple]:
+    '''
+    Ответы модели по чанкам (кластеры приводятся к normalize_llm_clusters);
+    упавший, не прошедший валидацию или незавершённый чанк — TF-IDF
+    '''
+    results = []
+    for chunk, future in zip(chunks, futures):
+        result = None
+        if future.done():
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f'[OPENAI] Error: {str(e)}, falling back to TF-IDF')
+        else:
+            print(f'[OPENAI] Chunk of {len(chunk)} phrases missed the budget, falling back to TF-IDF')
+        if result is None:
+            count_stage('llm_chunk_fallbacks')
+            result = clusterize_chunk_locally(chunk, mode)
+        else:
+            clusters, minus_words = result
+            result = (normalize_llm_clusters(chunk, clusters), minus_words)
+        results.append(result)
+    return results
+
+def collect_late_llm_result(chunks: List[List[Dict[str, Any]]], futures: list, mode: str, result_key: str,
+                            duplicate_members: Optional[Dict[str, List[Dict[str, Any]]]] = None):
+    '''
+    Фон: дожидается чанков, не успевших к бюджету запроса, и сохраняет собранный
+    ответ модели (с развёрнутыми почти-дублями). При ошибке сохраняется
+    {'error': ...} на LLM_FAILURE_TTL — GET по ключу отвечает ошибкой, а не 202
+    бесконечно; следующий успешный прогон тех же фраз перезаписывает её
+    '''
+    max_age = None
+    try:
+        wait(futures, timeout=LLM_BUDGET)
+        clusters, minus_words = reduce_chunk_clusters(gather_chunk_results(chunks, futures, mode))
+        if duplicate_members:
+            expand_near_duplicates(clusters, duplicate_members)
+            expand_near_duplicates(minus_words.values(), duplicate_members)
+        value = {'clusters': clusters, 'minus_words': minus_words}
+        print(f'[OPENAI] Late LLM result stored as {result_key}')
+    except Exception as e:
+        print(f'[OPENAI] Late LLM result {result_key} failed: {e}')
+        value = {'error': str(e)}
+        max_age = LLM_FAILURE_TTL
+    expires_at = time.time() + max_age if max_age else None
+    llm_result_cache.put(result_key, value, expires_at)
+    store_llm_cache(result_key, 'cluster_result', value)
+
+def clusterize_with_openai(phrases: List[Dict[str, Any]], mode: str = 'context', region_names: List[str] = None, selected_intents: List[str] = None, budget: float = LLM_RACE_BUDGET,
+                           duplicate_members: Optional[Dict[str, List[Dict[str, Any]]]] = None) -> tuple:
+    '''
+    Кластеризация через OpenAI GPT-4o с учётом регионов и интентов (map-reduce)
+    Фразы делятся на лексически однородные чанки по LLM_CHUNK_SIZE, чанки
+    кластеризуются моделью параллельно, кластеры сливаются по названиям.
+    Чанк, не прошедший валидацию, кластеризуется TF-IDF.
+    TF-IDF по всем фразам стартует одновременно с моделью: если модель не
+    уложилась в budget секунд, возвращается он, а ответ модели дособирается
+    в фоне (до LLM_BUDGET) и сохраняется в llm_cache под ключом pending_key
+    Args:
+        phrases: список фраз с частотностью
+        mode: 'context' (Яндекс.Директ) или 'seo' (SEO)
+        region_names: список регионов (например ['Москва', 'Санкт-Петербург'])
+        selected_intents: выбранные интенты (например ['commercial', 'transactional'])
+        budget: сколько секунд ждать модель
+        duplicate_members: почти-дубли из collapse_near_duplicates — ими
+                           разворачивается ответ, дособранный в фоне
+    Returns: (clusters, minus_words, pending_key) — pending_key None, если ответ от модели
+    '''
+    openai_key = os.environ.get('OPENAI_API_KEY')
+    if not openai_key:
+        print('[OPENAI] API key not found - using TF-IDF clustering')
+        clusters, minus_words = clusterize_chunk_locally(phrases, mode)
+        return clusters, minus_words, None
+    
+    regions_text = ', '.join(region_names) if region_names else 'Россия'
+    
+    intent_descriptions = {
+        'commercial': 'Коммерческие (купить, цена, заказать)',
+        'transactional': 'Транзакционные (оформить, записаться, получить)',
+        'informational': 'Информационные (как, что такое, инструкция)',
+        'navigational': 'Навигационные (сайт, официальный, контакты)'
+    }
+    
+    selected_intents_text = ', '.join([intent_descriptions.get(i, i) for i in selected_intents]) if selected_intents else 'Все типы'
+    
     proxy_url = os.environ.get('OPENAI_PROXY_URL')
     proxies = {}
     if proxy_url:
@@ -502,218 +1623,532 @@ def clusterize_with_openai(phrases: List[Dict[str, Any]], mode: str = 'context',
         }
         print(f'[OPENAI] Using proxy: {proxy_url[:20]}...')
     
-    try:
-        response = requests.post(
-            'https://api.openai.com/v1/chat/completions',
-            headers={
-                'Authorization': f'Bearer {openai_key}',
-                'Content-Type': 'application/json'
-            },
-            json={
-                'model': 'gpt-4o-mini',
-                'messages': [
-                    {'role': 'system', 'content': 'Ты эксперт по кластеризации запросов. Строго следуй инструкциям. Копируй фразы ТОЧНО как в списке. Отвечаешь только валидным JSON.'},
-                    {'role': 'user', 'content': prompt}
-                ],
-                'temperature': 0.0,
-                'response_format': {'type': 'json_object'}
-            },
-            proxies=proxies if proxies else None,
-            timeout=90
+    local_executor = ThreadPoolExecutor(max_workers=1)
+    local_future = local_executor.submit(copy_context().run, clusterize_chunk_locally, phrases, mode)
+    local_executor.shutdown(wait=False)
+    
+    with timed('llm_partition'):
+        chunks = partition_lexical_chunks(phrases)
+    print(f'[OPENAI] {len(phrases)} phrases split into {len(chunks)} chunks')
+    count_stage('llm_chunks', len(chunks))
+    
+    params = {'mode': mode, 'regions': regions_text, 'intents': selected_intents_text, 'temperature': 0.0}
+    deadline = time.monotonic() + LLM_BUDGET
+    executor = ThreadPoolExecutor(max_workers=min(LLM_WORKERS, len(chunks)))
+    futures = [
+        executor.submit(
+            copy_context().run, cached_llm_call, 'cluster',
+            [f"{p['phrase']}\t{p['count']}" for p in chunk],
+            params,
+            partial(clusterize_chunk_with_openai, chunk, mode, regions_text, selected_intents_text, openai_key, proxies, deadline)
         )
-        
-        if response.status_code == 200:
-            data = response.json()
-            content = data['choices'][0]['message']['content']
-            result = json.loads(content)
-            clusters = result.get('clusters', [])
-            minus_words = result.get('minus_words', {})
-            
-            # ВАЛИДАЦИЯ: проверяем что OpenAI не изменил фразы
-            original_phrases_set = {p['phrase'].strip().lower() for p in phrases}
-            clustered_phrases_set = set()
-            
-            for cluster in clusters:
-                for phrase_obj in cluster.get('phrases', []):
-                    clustered_phrases_set.add(phrase_obj['phrase'].strip().lower())
-            
-            # Проверяем что нет лишних фраз (которых не было в оригинале)
-            added_phrases = clustered_phrases_set - original_phrases_set
-            if added_phrases:
-                print(f'[OPENAI] ❌ ERROR: AI добавил {len(added_phrases)} фраз от себя! Откат к TF-IDF')
-                print(f'[OPENAI] Примеры добавленных: {list(added_phrases)[:3]}')
-                clusters = smart_clusterize(phrases, mode)
-                minus_words = detect_minus_words(phrases) if mode == 'context' else {}
-                return clusters, minus_words
-            
-            # Проверяем что OpenAI не удалил фразы
-            deleted_phrases = original_phrases_set - clustered_phrases_set
-            if deleted_phrases:
-                print(f'[OPENAI] ❌ ERROR: AI удалил {len(deleted_phrases)} фраз! Откат к TF-IDF')
-                print(f'[OPENAI] Примеры удалённых: {list(deleted_phrases)[:5]}')
-                clusters = smart_clusterize(phrases, mode)
-                minus_words = detect_minus_words(phrases) if mode == 'context' else {}
-                return clusters, minus_words
-            
-            print(f'[OPENAI] ✅ Валидация OK: {len(clusters)} кластеров, {len(clustered_phrases_set)}/{len(original_phrases_set)} фраз')
-            if minus_words:
-                total_minus = sum(len(v) for v in minus_words.values() if isinstance(v, list))
-                print(f'[OPENAI] Detected {total_minus} minus-words')
-            return clusters, minus_words
-        else:
-            print(f'[OPENAI] API error {response.status_code}: {response.text}, falling back to TF-IDF')
-            clusters = smart_clusterize(phrases, mode)
-            minus_words = detect_minus_words(phrases) if mode == 'context' else {}
-            return clusters, minus_words
-            
-    except Exception as e:
-        print(f'[OPENAI] Error: {str(e)}, falling back to TF-IDF')
-        clusters = smart_clusterize(phrases, mode)
-        minus_words = detect_minus_words(phrases) if mode == 'context' else {}
-        return clusters, minus_words
+        for chunk in chunks
+    ]
+    # Не отменяем: опоздавшие чанки дорабатывают и попадают в кэш
+    executor.shutdown(wait=False)
+    with timed('llm_map'):
+        _, pending = wait(futures, timeout=budget)
+    
+    if pending:
+        count_stage('llm_race_lost')
+        result_items = [f"{p['phrase']}\t{p['count']}" for p in phrases]
+        if duplicate_members:
+            result_items += [f"{phrase}\t{p['phrase']}\t{p['count']}" for phrase, group in duplicate_members.items() for p in group]
+        result_key = llm_cache_key('cluster_result', result_items, params)
+        threading.Thread(
+            target=copy_context().run,
+            args=(collect_late_llm_result, chunks, futures, mode, result_key, duplicate_members),
+            daemon=True
+        ).start()
+        with timed('local_clustering'):
+            clusters, minus_words = local_future.result()
+        print(f'[OPENAI] {len(pending)} of {len(chunks)} chunks missed the {budget:.0f}s budget, returning TF-IDF result, LLM result pending as {result_key}')
+        return clusters, minus_words, result_key
+    
+    results = gather_chunk_results(chunks, futures, mode)
+    with timed('llm_reduce'):
+        clusters, minus_words = reduce_chunk_clusters(results)
+    if minus_words:
+        total_minus = sum(len(v) if isinstance(v, list) else v.get('count', 0) for v in minus_words.values())
+        print(f'[OPENAI] Detected {total_minus} minus-words')
+    return clusters, minus_words, None
 
-def smart_clusterize(phrases: List[Dict[str, Any]], mode: str = 'seo') -> List[Dict[str, Any]]:
+SIMILARITY_DECIMALS = 9
+SIMILARITY_EPSILON = 1e-9
+
+def _center_neighbors(tfidf: TfidfMatrix, center: int, active, anchor, threshold: float, limit: int) -> tuple:
     '''
-    Супер-продвинутая кластеризация с разными режимами:
-    - mode='seo': Широкие кластеры (10-30 фраз) для контента
-    - mode='context': Базовые кластеры (10-50 фраз) для контекстной рекламы
+    Ближайшие активные центры не ниже порога: по убыванию близости, при
+    равенстве — по якорю кластера. Близости округляются до SIMILARITY_DECIMALS:
+    равные в точной арифметике (одинаковые наборы лемм у разных пар) не
+    различаются шумом последнего бита. Равные последнему оставленному не
+    отрезаются, чтобы выбор среди равных пар не зависел от limit
     '''
-    if not phrases:
-        return []
-    
-    competitors = ['авито', 'циан', 'домклик', 'яндекс недвижимость', 'юла', 'из рук в руки']
+    sims = tfidf.similarity_row(center)
+    sims[center] = -1
+    sims[~active] = -1
+    candidates = (sims >= threshold - SIMILARITY_EPSILON).nonzero()[0]
+    values = sims[candidates]
+    truncated = False
+    if len(candidates) > limit:
+        # Грубый отбор до округления: отброшенные округлятся строго меньше оставленных
+        kth = len(candidates) - limit
+        kept = values >= np.partition(values, kth)[kth] - SIMILARITY_EPSILON
+        truncated = not kept.all()
+        candidates, values = candidates[kept], values[kept]
+    values = values.round(SIMILARITY_DECIMALS)
+    kept = values >= threshold
+    if len(candidates) > limit:
+        kth = len(candidates) - limit
+        kept &= values >= np.partition(values, kth)[kth]
+        truncated = truncated or not kept[values >= threshold].all()
+    candidates, values = candidates[kept], values[kept]
+    order = np.lexsort((anchor[candidates], -values))
+    return values[order].tolist(), candidates[order].tolist(), truncated
+
+def merge_clusters_by_centers(tfidf: TfidfMatrix, counts: List[int], threshold: float, target_clusters: int, max_iterations: int, neighbors_limit: int = 32, history: Optional[list] = None) -> List[List[int]]:
+    '''
+    Агломеративное слияние кластеров через min-heap
+    Близость кластеров — близость их центров (самых частотных фраз), поэтому
+    после слияния центр нового кластера — один из двух старых центров, а
+    второй просто выбывает. Для каждого центра держим короткий список
+    ближайших соседей, в куче — только лучший сосед каждого центра;
+    после слияния пересчитывается лишь строка центра, у которого кончились соседи
+    Среди равных по близости пар сливается пара с меньшими якорями
+    (позициями кластеров в списке), как в исходном переборе всех пар: ключ
+    кучи — (-близость, меньший якорь, больший якорь). Якорь победителя может
+    уменьшиться — тогда списки центров, где он есть, пересортировываются
+    history: сюда дописываются слияния (центр a, центр b, близость) —
+    близость не растёт, поэтому любой префикс воспроизводит replay_merges
+    tfidf может быть и JaccardBitsets — нужен только similarity_row
+    Returns: списки индексов фраз по кластерам
+    '''
+    n = len(counts)
+    active = np.ones(n, dtype=bool)
+    members = {i: [i] for i in range(n)}
+    anchor = np.arange(n)
+    version = [0] * n
+    extra_referrers = defaultdict(list)
+    neighbors = {}
+    heap = []
+    
+    def push_best(center: int):
+        '''Новая запись центра в куче (старые записи устаревают по version)'''
+        sims, ids, pos, truncated = neighbors[center]
+        while pos < len(ids) and not active[ids[pos]]:
+            pos += 1
+        if pos == len(ids) and truncated:
+            sims, ids, truncated = _center_neighbors(tfidf, center, active, anchor, threshold, neighbors_limit)
+            pos = 0
+            for neighbor in ids:
+                extra_referrers[neighbor].append(center)
+        neighbors[center] = [sims, ids, pos, truncated]
+        version[center] += 1
+        if pos < len(ids):
+            neighbor = ids[pos]
+            low, high = sorted((int(anchor[center]), int(anchor[neighbor])))
+            heapq.heappush(heap, (-sims[pos], low, high, center, neighbor, version[center]))
+    
+    for center in range(n):
+        sims, ids, truncated = _center_neighbors(tfidf, center, active, anchor, threshold, neighbors_limit)
+        neighbors[center] = [sims, ids, 0, truncated]
+    
+    # Обратный индекс (CSR): в списках каких центров стоит фраза;
+    # пересчитанные позже списки дописываются в extra_referrers
+    lengths = np.fromiter((len(neighbors[c][1]) for c in range(n)), dtype=np.int64, count=n)
+    listed = np.fromiter(chain.from_iterable(neighbors[c][1] for c in range(n)), dtype=np.int64, count=int(lengths.sum()))
+    referrer_rows = np.repeat(np.arange(n), lengths)[np.argsort(listed, kind='stable')]
+    referrer_indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(listed, minlength=n), out=referrer_indptr[1:])
+    for center in range(n):
+        push_best(center)
+    
+    merges = 0
+    while heap and merges < max_iterations and len(members) > target_clusters:
+        neg_sim, _, _, a, b, entry_version = heapq.heappop(heap)
+        if not active[a] or entry_version != version[a]:
+            continue
+        
+        if not active[b]:
+            push_best(a)
+            continue
+        
+        # Центр объединённого кластера — самая частотная фраза
+        # (при равенстве — центр кластера, который стоит раньше)
+        first, second = (a, b) if anchor[a] < anchor[b] else (b, a)
+        winner, loser = (first, second) if counts[first] >= counts[second] else (second, first)
+        
+        merged = members.pop(first) + members.pop(second)
+        members[winner] = merged
+        anchor_moved = winner != first
+        anchor[winner] = anchor[first]
+        active[loser] = False
+        del neighbors[loser]
+        merges += 1
+        if history is not None:
+            history.append((a, b, -neg_sim))
+        
+        push_best(winner)
+        if anchor_moved:
+            referrers = referrer_rows[referrer_indptr[winner]:referrer_indptr[winner + 1]].tolist()
+            for center in set(referrers + extra_referrers[winner]):
+                if not active[center] or center == winner:
+                    continue
+                sims, ids, pos, truncated = neighbors[center]
+                order = sorted(range(pos, len(ids)), key=lambda k: (-sims[k], anchor[ids[k]]))
+                neighbors[center] = [[sims[k] for k in order], [ids[k] for k in order], 0, truncated]
+                push_best(center)
+    
+    return [members[c] for c in sorted(members, key=lambda c: anchor[c])]
+
+def replay_merges(counts: List[int], merges: List[tuple]) -> List[List[int]]:
+    '''Кластеры после слияний merges (из history) — как их вернул бы merge_clusters_by_centers'''
+    members = {i: [i] for i in range(len(counts))}
+    anchor = list(range(len(counts)))
+    for a, b, _ in merges:
+        first, second = (a, b) if anchor[a] < anchor[b] else (b, a)
+        winner = first if counts[first] >= counts[second] else second
+        merged = members.pop(first) + members.pop(second)
+        members[winner] = merged
+        anchor[winner] = anchor[first]
+    return [members[c] for c in sorted(members, key=lambda c: anchor[c])]
+
+SMART_NAMING_STOP_WORDS = {
+    'купить', 'заказать', 'цена', 'стоимость', 'недорого', 
+    'дешево', 'москва', 'спб', 'россия', 'доставка'
+}
+
+def smart_clustering_params(mode: str) -> tuple:
+    '''Порог близости и число фраз на целевой кластер для режима'''
+    if mode == 'context':
+        return 0.05, 25
+    return 0.08, 15
+
+def target_cluster_count(n: int, target_clusters_ratio: int, max_target_clusters: int) -> int:
+    return max(3, min(max_target_clusters, n // target_clusters_ratio))
+
+def split_competitor_phrases(phrases: List[Dict[str, Any]]) -> tuple:
+    '''Returns: (regular_phrases, competitor_phrases) — фразы с агрегаторами и конкурентами отдельно'''
     competitor_phrases = []
     regular_phrases = []
     
     for p in phrases:
-        is_competitor = any(comp in p['phrase'].lower() for comp in competitors)
+        is_competitor = label_phrase(p['phrase'].lower())[3]
         if is_competitor:
             competitor_phrases.append(p)
         else:
             regular_phrases.append(p)
+    return regular_phrases, competitor_phrases
+
+def lemmatize_table(table: PhraseTable) -> array:
+    '''Леммы всех токенов таблицы с замером и счётчиками кэша лемм'''
+    with timed('lemmatization'):
+        lemma_stats_before = lemma_cache_stats()
+        lemma_ids = table.lemma_ids()
+    lemma_stats = lemma_cache_stats()
+    count_stage('lemma_lru_hits', lemma_stats['lru_hits'] - lemma_stats_before['lru_hits'])
+    count_stage('lemma_lru_misses', lemma_stats['lru_misses'] - lemma_stats_before['lru_misses'])
+    count_stage('lemma_store_hits', lemma_stats['store_hits'] - lemma_stats_before['store_hits'])
+    print(f'[LEMMA] Cache stats: {lemma_stats}')
+    return lemma_ids
+
+def build_named_clusters(table: PhraseTable, clusters: List[List[int]], competitor_phrases: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    '''
+    Кластеры smart_clusterize в формате ответа: название по двум самым
+    частым леммам, преобладающий интент, сортировка по суммарной частотности;
+    агрегаторы и конкуренты — отдельным последним кластером
+    '''
+    lemma_ids = table.lemma_ids()
+    lemmas = table.lemmas
     
-    if mode == 'context':
-        similarity_threshold = 0.05
-        target_clusters_ratio = 25
-    else:
-        similarity_threshold = 0.08
-        target_clusters_ratio = 15
+    with timed('naming'):
+        result = []
+        for cluster_indices in clusters:
+            sorted_phrases = table.sorted_by_count(cluster_indices)
+            
+            lemmas_counter = defaultdict(int)
+            for idx in cluster_indices:
+                for token in table.word_ids(idx):
+                    lemma_id = lemma_ids[token]
+                    word = lemmas[lemma_id]
+                    if len(word) > 2 and word not in SMART_NAMING_STOP_WORDS:
+                        lemmas_counter[lemma_id] += 1
+            
+            if lemmas_counter:
+                top_words = [lemmas[w] for w, _ in heapq.nlargest(2, lemmas_counter.items(), key=lambda x: x[1])]
+                cluster_name = ' '.join(top_words).title()
+            else:
+                words = sorted_phrases[0]['phrase'].split()
+                cluster_name = ' '.join(words[:2]).title()
+            
+            intent_counts = defaultdict(int)
+            for idx in cluster_indices:
+                intent_counts[detect_intent_lowered(table.lowered[idx])] += 1
+            dominant_intent = max(intent_counts.items(), key=lambda x: x[1])[0]
+            
+            result.append(build_cluster(
+                cluster_name,
+                dominant_intent,
+                sorted_phrases,
+                ClusterStats.of_table(table, cluster_indices)
+            ))
     
-    phrases = regular_phrases
+    result.sort(key=lambda x: x['total_count'], reverse=True)
     
-    if len(phrases) == 0:
-        return []
+    if competitor_phrases:
+        result.append(build_cluster(
+            'Агрегаторы и конкуренты',
+            'general',
+            sorted(competitor_phrases, key=lambda x: x['count'], reverse=True)
+        ))
     
-    if len(phrases) < 5:
-        return [{
-            'cluster_name': 'Все запросы',
-            'total_count': sum(p['count'] for p in phrases),
-            'phrases_count': len(phrases),
-            'avg_words': round(sum(len(p['phrase'].split()) for p in phrases) / len(phrases), 1) if len(phrases) > 0 else 0,
-            'max_frequency': max(p['count'] for p in phrases),
-            'min_frequency': min(p['count'] for p in phrases),
-            'intent': detect_intent(phrases[0]['phrase']),
-            'phrases': sorted(phrases, key=lambda x: x['count'], reverse=True)
-        }]
+    return result
+
+DENDROGRAM_VERSION = 2
+
+def dendrogram_cut(clusters: List[Dict[str, Any]], applied: int) -> Dict[str, Any]:
+    '''
+    Разрез исходного ответа: число слияний и [название, фраз, суммарная
+    частотность] каждого кластера — по нему backend/api проверяет, что
+    перерезка на applied слияниях совпадает с ответом
+    '''
+    return {
+        'merges': applied,
+        'clusters': [[c['cluster_name'], c['phrases_count'], c['total_count']] for c in clusters]
+    }
+
+def build_dendrogram(table: PhraseTable, mode: str, threshold: float, history: List[tuple], applied: int, competitor_phrases: List[Dict[str, Any]], similarity: str = 'tfidf', clusters: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+    '''
+    История слияний smart_clusterize с данными для перерезки без пересчёта
+    (см. cut_dendrogram в backend/api): фразы-представители, их интенты и
+    леммы для названий, слияния [a, b, близость] по убыванию близости,
+    число слияний в исходном ответе, его разрез (dendrogram_cut) и фразы конкурентов;
+    similarity — мера близости ('tfidf' или 'jaccard'), в ней же пороги перерезки.
+    version — DENDROGRAM_VERSION, backend/api читает только свою версию
+    '''
+    lemma_ids = table.lemma_ids()
+    lemmas = table.lemmas
+    phrase_lemmas = []
+    for i in range(len(table)):
+        ids = [lemma_ids[token] for token in table.word_ids(i)]
+        phrase_lemmas.append([l for l in ids if len(lemmas[l]) > 2 and lemmas[l] not in SMART_NAMING_STOP_WORDS])
     
-    lemmatized = [lemmatize_phrase(p['phrase']) for p in phrases]
+    return {
+        'version': DENDROGRAM_VERSION,
+        'mode': mode,
+        'min_similarity': threshold,
+        'similarity': similarity,
+        'phrases': table.records,
+        'intents': [detect_intent_lowered(phrase) for phrase in table.lowered],
+        'lemmas': lemmas,
+        'phrase_lemmas': phrase_lemmas,
+        'merges': [[a, b, round(similarity, 6)] for a, b, similarity in history],
+        'applied_merges': applied,
+        'competitors': competitor_phrases,
+        'duplicates': {},
+        'cut': dendrogram_cut(clusters or [], applied)
+    }
+
+def smart_clusterize(phrases: List[Dict[str, Any]], mode: str = 'seo', max_iterations: int = 50, max_target_clusters: int = 20, return_dendrogram: bool = False, idf_blend: float = 0.0, similarity: str = 'tfidf'):
+    '''
+    Супер-продвинутая кластеризация с разными режимами:
+    - mode='seo': Широкие кластеры (10-30 фраз) для контента
+    - mode='context': Базовые кластеры (10-50 фраз) для контекстной рекламы
+    max_iterations: максимум слияний, max_target_clusters: верхняя граница
+    целевого числа кластеров (для больших семантических ядер можно поднимать)
+    return_dendrogram: вернуть (clusters, dendrogram) — слияния идут до конца,
+    а кластеры ответа — тот же префикс истории; dendrogram = None для < 5 фраз
+    idf_blend: доля глобального IDF лемм в весах (0 — только IDF запроса)
+    similarity: 'tfidf' (косинус) или 'jaccard' (битовые множества лемм)
+    '''
+    phrases, competitor_phrases = split_competitor_phrases(phrases)
+    similarity_threshold, target_clusters_ratio = smart_clustering_params(mode)
     
-    tfidf_vectors = calculate_tfidf(lemmatized)
+    if len(phrases) < 5:
+        result = []
+        if phrases:
+            result.append(build_cluster(
+                'Все запросы',
+                detect_intent(phrases[0]['phrase']),
+                sorted(phrases, key=lambda x: x['count'], reverse=True)
+            ))
+        return (result, None) if return_dendrogram else result
+    
+    table = PhraseTable(phrases)
+    lemmatize_table(table)
+    
+    if similarity == 'jaccard':
+        with timed('bitsets'):
+            vectors = JaccardBitsets(table)
+    else:
+        with timed('tfidf'):
+            vectors = build_tfidf_from_table(table, use_lemmas=True, idf_blend=idf_blend)
     
     n = len(phrases)
     
-    clusters = [[i] for i in range(n)]
-    cluster_centers = list(range(n))
-    
-    target_clusters = max(3, min(20, n // target_clusters_ratio))
-    max_iterations = min(50, n)
-    
-    for iteration in range(max_iterations):
-        if len(clusters) <= target_clusters:
-            break
-            
-        max_sim = -1
-        merge_pair = None
-        
-        for i in range(len(clusters)):
-            for j in range(i+1, len(clusters)):
-                center_i = cluster_centers[i]
-                center_j = cluster_centers[j]
-                sim = cosine_similarity_simple(tfidf_vectors[center_i], tfidf_vectors[center_j])
-                
-                if sim > max_sim:
-                    max_sim = sim
-                    merge_pair = (i, j)
-        
-        if max_sim < similarity_threshold or merge_pair is None:
-            break
+    target_clusters = target_cluster_count(n, target_clusters_ratio, max_target_clusters)
+    max_merges = min(max_iterations, n)
+    with timed('similarity'):
+        if return_dendrogram:
+            history = []
+            merge_clusters_by_centers(vectors, table.counts, similarity_threshold, 1, n, history=history)
+            applied = min(max_merges, n - target_clusters, len(history))
+            clusters = replay_merges(table.counts, history[:applied])
+        else:
+            clusters = merge_clusters_by_centers(
+                vectors,
+                table.counts,
+                similarity_threshold,
+                target_clusters,
+                max_merges
+            )
+    
+    result = build_named_clusters(table, clusters, competitor_phrases)
+    if return_dendrogram:
+        return result, build_dendrogram(table, mode, similarity_threshold, history, applied, competitor_phrases, similarity, result)
+    return result
+
+KMEANS_MAX_CLUSTERS = int(os.environ.get('KMEANS_MAX_CLUSTERS', '300'))
+KMEANS_MAX_FEATURES = int(os.environ.get('KMEANS_MAX_FEATURES', '5000'))
+KMEANS_BATCH_SIZE = 1024
+KMEANS_MAX_ITERATIONS = 100
+
+def cap_tfidf_features(tfidf: TfidfMatrix, max_features: int) -> tuple:
+    '''
+    Оставляет max_features самых частых по документам термов и заново
+    нормирует строки. Returns: (indptr, indices, data, n_features)
+    '''
+    doc_freq = np.diff(tfidf.col_indptr)
+    n_features = len(doc_freq)
+    if n_features <= max_features:
+        return tfidf.indptr, tfidf.indices, tfidf.data, n_features
+    
+    kept = np.argsort(-doc_freq, kind='stable')[:max_features]
+    column = np.full(n_features, -1, dtype=np.int64)
+    column[kept] = np.arange(max_features)
+    
+    rows = np.repeat(np.arange(tfidf.n_rows), np.diff(tfidf.indptr))
+    mask = column[tfidf.indices] >= 0
+    rows = rows[mask]
+    indices = column[tfidf.indices[mask]]
+    data = tfidf.data[mask]
+    
+    norms = np.sqrt(np.bincount(rows, weights=data * data, minlength=tfidf.n_rows))
+    data = data / norms[rows]
+    indptr = np.zeros(tfidf.n_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=tfidf.n_rows), out=indptr[1:])
+    return indptr, indices, data, max_features
+
+def _gather_rows(indptr, rows) -> tuple:
+    '''Позиции ненулевых элементов строк rows в CSR и номер строки (в rows) для каждого'''
+    starts = indptr[rows]
+    lengths = indptr[rows + 1] - starts
+    local = np.repeat(np.arange(len(rows)), lengths)
+    offsets = np.cumsum(lengths) - lengths
+    positions = np.arange(lengths.sum()) - np.repeat(offsets, lengths) + np.repeat(starts, lengths)
+    return positions, local
+
+def _nearest_centers(indptr, indices, data, rows, centers) -> np.ndarray:
+    '''
+    Номер ближайшего (по косинусу) центра для каждой непустой строки rows
+    Фразы короткие, поэтому близости копятся по j-му терму всех строк сразу;
+    строки упорядочены по убыванию длины, и строки с j-м термом — префикс
+    '''
+    order = np.argsort(indptr[rows] - indptr[rows + 1], kind='stable')
+    starts = indptr[rows[order]]
+    lengths = indptr[rows[order] + 1] - starts
+    similarities = np.zeros((len(rows), centers.shape[1]), dtype=centers.dtype)
+    for j in range(int(lengths[0])):
+        count = int(np.searchsorted(-lengths, -j, side='left'))
+        positions = starts[:count] + j
+        similarities[:count] += centers[indices[positions]] * data[positions, None].astype(centers.dtype)
+    nearest = np.empty(len(rows), dtype=np.int64)
+    nearest[order] = similarities.argmax(axis=1)
+    return nearest
+
+def minibatch_spherical_kmeans(indptr, indices, data, n_features: int, k: int,
+                               batch_size: int = KMEANS_BATCH_SIZE, max_iterations: int = KMEANS_MAX_ITERATIONS,
+                               tolerance: float = 1e-4, seed: int = 0) -> np.ndarray:
+    '''
+    Mini-batch k-means (Sculley, 2010) на единичной сфере для CSR строк с L2-нормой 1
+    Центры — плотные столбцы матрицы (n_features × k), каждый батч сдвигает
+    центр к среднему назначенных ему строк с шагом 1/(число увиденных строк),
+    после чего центр снова нормируется. Память: центры и батч, а не n × k
+    Returns: номер кластера для каждой строки, -1 для строк без термов
+    '''
+    n_rows = len(indptr) - 1
+    labels = np.full(n_rows, -1, dtype=np.int64)
+    nonempty = np.nonzero(np.diff(indptr) > 0)[0]
+    if len(nonempty) == 0:
+        return labels
+    
+    rng = np.random.default_rng(seed)
+    k = min(k, len(nonempty))
+    centers = np.zeros((n_features, k))
+    positions, local = _gather_rows(indptr, rng.choice(nonempty, size=k, replace=False))
+    centers[indices[positions], local] = data[positions]
+    seen = np.zeros(k)
+    
+    for _ in range(max_iterations):
+        batch = rng.choice(nonempty, size=min(batch_size, len(nonempty)), replace=False)
+        assigned = _nearest_centers(indptr, indices, data, batch, centers)
         
-        i, j = merge_pair
-        clusters[i].extend(clusters[j])
+        positions, local = _gather_rows(indptr, batch)
+        sums = np.bincount(indices[positions] * k + assigned[local], weights=data[positions],
+                           minlength=n_features * k).reshape(n_features, k)
+        batch_counts = np.bincount(assigned, minlength=k)
+        seen += batch_counts
         
-        max_count_idx = max(clusters[i], key=lambda idx: phrases[idx]['count'])
-        cluster_centers[i] = max_count_idx
+        # Центры без строк в батче не меняются: шаг 0 и нулевая сумма
+        scale = 1 / np.maximum(seen, 1)
+        previous = centers.copy()
+        centers *= 1 - batch_counts * scale
+        centers += sums * scale
+        norms = np.sqrt(np.einsum('ij,ij->j', centers, centers))
+        centers /= np.where(norms > 0, norms, 1)
         
-        del clusters[j]
-        del cluster_centers[j]
+        if np.max(np.abs(centers - previous)) < tolerance:
+            break
     
-    stop_words_for_naming = {
-        'купить', 'заказать', 'цена', 'стоимость', 'недорого', 
-        'дешево', 'москва', 'спб', 'россия', 'доставка'
-    }
+    for start in range(0, len(nonempty), batch_size * 4):
+        rows = nonempty[start:start + batch_size * 4]
+        labels[rows] = _nearest_centers(indptr, indices, data, rows, centers)
+    return labels
+
+def kmeans_clusterize(phrases: List[Dict[str, Any]], mode: str = 'seo', max_target_clusters: int = KMEANS_MAX_CLUSTERS, idf_blend: float = 0.0) -> List[Dict[str, Any]]:
+    '''
+    Кластеризация больших ядер (100k+ фраз) за линейное время: mini-batch
+    сферический k-means по TF-IDF лемм. Число кластеров — как в
+    smart_clusterize (n // target_clusters_ratio), но с верхней границей
+    max_target_clusters; формат ответа тот же
+    '''
+    if not phrases:
+        return []
     
-    result = []
-    for cluster_indices in clusters:
-        cluster_phrases = [phrases[i] for i in cluster_indices]
-        sorted_phrases = sorted(cluster_phrases, key=lambda x: x['count'], reverse=True)
-        
-        lemmas_counter = defaultdict(int)
-        for idx in cluster_indices:
-            lemma = lemmatized[idx]
-            for word in lemma.split():
-                if len(word) > 2 and word not in stop_words_for_naming:
-                    lemmas_counter[word] += 1
-        
-        if lemmas_counter:
-            sorted_words = sorted(lemmas_counter.items(), key=lambda x: x[1], reverse=True)
-            top_words = [w for w, _ in sorted_words[:2]]
-            cluster_name = ' '.join(top_words).title()
-        else:
-            words = sorted_phrases[0]['phrase'].split()
-            cluster_name = ' '.join(words[:2]).title()
-        
-        intents = [detect_intent(p['phrase']) for p in cluster_phrases]
-        intent_counts = defaultdict(int)
-        for intent in intents:
-            intent_counts[intent] += 1
-        dominant_intent = max(intent_counts.items(), key=lambda x: x[1])[0]
-        
-        result.append({
-            'cluster_name': cluster_name,
-            'total_count': sum(p['count'] for p in cluster_phrases),
-            'phrases_count': len(cluster_phrases),
-            'avg_words': round(sum(len(p['phrase'].split()) for p in cluster_phrases) / len(cluster_phrases), 1),
-            'max_frequency': max(p['count'] for p in cluster_phrases),
-            'min_frequency': min(p['count'] for p in cluster_phrases),
-            'intent': dominant_intent,
-            'phrases': sorted_phrases
-        })
+    phrases, competitor_phrases = split_competitor_phrases(phrases)
+    _, target_clusters_ratio = smart_clustering_params(mode)
     
-    result.sort(key=lambda x: x['total_count'], reverse=True)
+    if len(phrases) < 5:
+        return smart_clusterize(phrases + competitor_phrases, mode)
     
-    if competitor_phrases:
-        result.append({
-            'cluster_name': 'Агрегаторы и конкуренты',
-            'total_count': sum(p['count'] for p in competitor_phrases),
-            'phrases_count': len(competitor_phrases),
-            'avg_words': round(sum(len(p['phrase'].split()) for p in competitor_phrases) / len(competitor_phrases), 1),
-            'max_frequency': max(p['count'] for p in competitor_phrases),
-            'min_frequency': min(p['count'] for p in competitor_phrases),
-            'intent': 'general',
-            'phrases': sorted(competitor_phrases, key=lambda x: x['count'], reverse=True)
-        })
+    table = PhraseTable(phrases)
+    lemmatize_table(table)
     
-    return result
+    with timed('tfidf'):
+        tfidf = build_tfidf_from_table(table, use_lemmas=True, idf_blend=idf_blend)
+        indptr, indices, data, n_features = cap_tfidf_features(tfidf, KMEANS_MAX_FEATURES)
+    
+    k = target_cluster_count(len(phrases), target_clusters_ratio, max_target_clusters)
+    with timed('similarity'):
+        labels = minibatch_spherical_kmeans(indptr, indices, data, n_features, k)
+    
+    # Фразы без значимых слов (label -1) собираются в отдельный кластер
+    order = np.argsort(labels, kind='stable')
+    bounds = np.nonzero(np.diff(labels[order]))[0] + 1
+    clusters = [group.tolist() for group in np.split(order, bounds)]
+    print(f'[KMEANS] {len(phrases)} phrases, {n_features} features, k={k}: {len(clusters)} clusters')
+    
+    return build_named_clusters(table, clusters, competitor_phrases)
 
 def generate_geo_keywords(address: str, base_query: str) -> List[str]:
     '''
@@ -748,14 +2183,14 @@ def generate_geo_keywords(address: str, base_query: str) -> List[str]:
 Пример: купить квартиру Кулакова, купить квартиру Кулакова 1, купить квартиру Северо-Западный район, купить квартиру рядом с Тухачевским рынком
 
 Ответ:"""
-
+    
     headers = {
         'Content-Type': 'application/json',
         'Authorization': f'Bearer {openai_key}'
     }
     
     payload = {
-        'model': 'gpt-4o-mini',
+        'model': LLM_MODEL,
         'messages': [{'role': 'user', 'content': prompt}],
         'temperature': 0.7,
         'max_tokens': 400
@@ -786,11 +2221,579 @@ def generate_geo_keywords(address: str, base_query: str) -> List[str]:
         
         print(f'[GEO] Generated {len(variations)} geo variations')
         return variations[:25]  # Limit to 25
-        
+    
     except Exception as e:
         print(f'[GEO] Error: {e}')
         return []
 
+WORDSTAT_API_URL = 'https://api.wordstat.yandex.net/v1/topRequests'
+WORDSTAT_DEFAULT_DEPTH = 50
+WORDSTAT_CACHE_TTL = int(os.environ.get('WORDSTAT_CACHE_TTL', '21600'))
+WORDSTAT_CACHE_SIZE = int(os.environ.get('WORDSTAT_CACHE_SIZE', '256'))
+WORDSTAT_RPS = float(os.environ.get('WORDSTAT_RPS', '10'))
+WORDSTAT_WORKERS = int(os.environ.get('WORDSTAT_WORKERS', '8'))
+FREQUENCY_LOOKUP_BUDGET = float(os.environ.get('FREQUENCY_LOOKUP_BUDGET', '12'))
+
+class RateLimiter:
+    '''Token bucket, общий для всех потоков процесса'''
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self, deadline: Optional[float] = None) -> bool:
+        '''Ждёт токен; False, если до дедлайна (time.monotonic) его не дождаться'''
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait_s = (1 - self.tokens) / self.rate
+            if deadline is not None and now + wait_s > deadline:
+                return False
+            time.sleep(wait_s)
+
+wordstat_limiter = RateLimiter(WORDSTAT_RPS, max(1, int(WORDSTAT_RPS)))
+
+class TTLCache:
+    '''In-process LRU с временем жизни записей; потокобезопасный'''
+    def __init__(self, maxsize: int, ttl: int):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+    
+    def _live(self, key):
+        # Вызывается под self.lock
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.time():
+            del self.entries[key]
+            return None
+        return entry
+    
+    def get(self, key) -> Any:
+        with self.lock:
+            entry = self._live(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+    
+    def put(self, key, value: Any, expires_at: Optional[float] = None):
+        with self.lock:
+            self._store(key, value, expires_at)
+    
+    def _store(self, key, value: Any, expires_at: Optional[float]):
+        self.entries[key] = (expires_at or time.time() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+class WordstatCache(TTLCache):
+    '''
+    Кэш ответов topRequests.
+    Запись хранит глубину (numPhrases) и обслуживает любой запрос не глубже себя
+    '''
+    def get_depth(self, key: tuple, depth: int) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            entry = self._live(key)
+            if entry is None or not covers_depth(entry[1][0], entry[1][1], depth):
+                return None
+            self.entries.move_to_end(key)
+            return entry[1][1]
+    
+    def put_depth(self, key: tuple, depth: int, data: Dict[str, Any], expires_at: float):
+        with self.lock:
+            current = self._live(key)
+            if current is not None and current[1][0] > depth:
+                return
+            self._store(key, (depth, data), expires_at)
+
+wordstat_cache = WordstatCache(WORDSTAT_CACHE_SIZE, WORDSTAT_CACHE_TTL)
+
+def canonical_cache_key(phrase: str, regions: List[int]) -> tuple:
+    '''Регистр и лишние пробелы не важны для Wordstat; операторы (!, +, кавычки) сохраняются'''
+    return ' '.join(phrase.lower().split()), ','.join(str(r) for r in sorted(set(int(r) for r in regions or [])))
+
+def covers_depth(cached_depth: int, data: Dict[str, Any], depth: int) -> bool:
+    # Если Wordstat вернул меньше фраз, чем просили, более глубокий запрос ничего не добавит
+    return cached_depth >= depth or len(data.get('topRequests', [])) < cached_depth
+
+def slice_depth(data: Dict[str, Any], depth: int) -> Dict[str, Any]:
+    top = data.get('topRequests', [])
+    if len(top) <= depth:
+        return data
+    return {**data, 'topRequests': top[:depth]}
+
+def load_cached_response(key: tuple, depth: int) -> Optional[Dict[str, Any]]:
+    try:
+        dsn = os.environ.get('DATABASE_URL')
+        conn = psycopg2.connect(dsn, cursor_factory=RealDictCursor)
+        cur = conn.cursor()
+        cur.execute(
+            """SELECT num_phrases, response, fetched_at FROM wordstat_cache
+               WHERE phrase = %s AND regions = %s AND fetched_at > %s""",
+            (key[0], key[1], datetime.now() - timedelta(seconds=WORDSTAT_CACHE_TTL))
+        )
+        row = cur.fetchone()
+        cur.close()
+        conn.close()
+    except Exception as e:
+        print(f'[WORDSTAT CACHE] Load error: {e}')
+        return None
+    
+    if not row:
+        return None
+    data = row['response']
+    expires_at = time.time() - (datetime.now() - row['fetched_at']).total_seconds() + WORDSTAT_CACHE_TTL
+    wordstat_cache.put_depth(key, row['num_phrases'], data, expires_at)
+    if not covers_depth(row['num_phrases'], data, depth):
+        return None
+    return data
+
+def store_cached_response(key: tuple, depth: int, data: Dict[str, Any]):
+    '''Более мелкий ответ не затирает более глубокий, пока тот не истёк'''
+    try:
+        dsn = os.environ.get('DATABASE_URL')
+        conn = psycopg2.connect(dsn)
+        cur = conn.cursor()
+        cur.execute(
+            """INSERT INTO wordstat_cache (phrase, regions, num_phrases, response, fetched_at)
+               VALUES (%s, %s, %s, %s, CURRENT_TIMESTAMP)
+               ON CONFLICT (phrase, regions) DO UPDATE SET
+                   num_phrases = EXCLUDED.num_phrases,
+                   response = EXCLUDED.response,
+                   fetched_at = EXCLUDED.fetched_at
+               WHERE wordstat_cache.num_phrases <= EXCLUDED.num_phrases
+                  OR wordstat_cache.fetched_at <= %s""",
+            (key[0], key[1], depth, json.dumps(data, ensure_ascii=False),
+             datetime.now() - timedelta(seconds=WORDSTAT_CACHE_TTL))
+        )
+        conn.commit()
+        cur.close()
+        conn.close()
+    except Exception as e:
+        print(f'[WORDSTAT CACHE] Store error: {e}')
+
+def fetch_top_requests(phrase: str, regions: List[int], headers: Dict[str, str], num_phrases: Optional[int] = None, timeout: float = 30, deadline: Optional[float] = None) -> tuple:
+    '''
+    topRequests через двухуровневый кэш (память процесса → Postgres → API).
+    Возвращает (status_code, data); в кэш попадают только успешные ответы.
+    Запросы к API проходят через общий rate limit; не дождавшись его до deadline — (429, None)
+    '''
+    depth = num_phrases or WORDSTAT_DEFAULT_DEPTH
+    key = canonical_cache_key(phrase, regions)
+    
+    data = wordstat_cache.get_depth(key, depth)
+    if data is None:
+        data = load_cached_response(key, depth)
+    if data is not None:
+        count_stage('wordstat_cache_hits')
+        return 200, slice_depth(data, depth)
+    
+    count_stage('wordstat_cache_misses')
+    if not wordstat_limiter.acquire(deadline):
+        count_stage('wordstat_rate_limited')
+        return 429, None
+    if deadline is not None:
+        timeout = min(timeout, max(0.1, deadline - time.monotonic()))
+    payload = {'phrase': phrase, 'regions': regions}
+    if num_phrases:
+        payload['numPhrases'] = num_phrases
+    response = requests.post(WORDSTAT_API_URL, json=payload, headers=headers, timeout=timeout)
+    if response.status_code != 200:
+        return response.status_code, None
+    
+    data = response.json()
+    if 'error' not in data:
+        wordstat_cache.put_depth(key, depth, data, time.time() + WORDSTAT_CACHE_TTL)
+        store_cached_response(key, depth, data)
+        record_idf_phrases([p['phrase'] for p in data.get('topRequests', [])])
+    return 200, data
+
+LLM_MODEL = 'gpt-4o-mini'
+# Версия шаблона промпта входит в ключ кэша: правка промпта — новая версия
+LLM_PROMPT_VERSIONS = {'cluster': 'cluster-v1', 'cluster_result': 'cluster-v1', 'geo': 'geo-v1'}
+LLM_CACHE_SIZE = int(os.environ.get('LLM_CACHE_SIZE', '1024'))
+GEO_VARIATIONS_TTL = int(os.environ.get('GEO_VARIATIONS_TTL', '604800'))
+# Срок жизни записей llm_cache по видам (секунды от created_at); вид без срока не устаревает
+LLM_CACHE_TTLS = {'geo': GEO_VARIATIONS_TTL}
+
+LLM_FAILURE_TTL = int(os.environ.get('LLM_FAILURE_TTL', '600'))
+
+llm_memory_cache = TTLCache(LLM_CACHE_SIZE, 86400)
+# Дособранные в фоне ответы (PendingLlmResult) — отдельно от ответов по чанкам
+llm_result_cache = TTLCache(LLM_CACHE_SIZE, 86400)
+llm_cache_stats = {'memory_hits': 0, 'db_hits': 0, 'misses': 0}
+
+def llm_cache_key(kind: str, items: List[str], params: Dict[str, Any]) -> str:
+    '''sha256 от (модель, версия промпта, отсортированный набор фраз, параметры) — порядок фраз не важен'''
+    payload = json.dumps({
+        'model': LLM_MODEL,
+        'prompt_version': LLM_PROMPT_VERSIONS[kind],
+        'items': sorted(items),
+        'params': params
+    }, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def load_llm_cache(key: str, max_age: Optional[int] = None) -> Any:
+    try:
+        dsn = os.environ.get('DATABASE_URL')
+        conn = psycopg2.connect(dsn, cursor_factory=RealDictCursor)
+        cur = conn.cursor()
+        if max_age is None:
+            cur.execute(
+                "UPDATE llm_cache SET hits = hits + 1, last_hit_at = CURRENT_TIMESTAMP WHERE cache_key = %s RETURNING response",
+                (key,)
+            )
+        else:
+            cur.execute(
+                """UPDATE llm_cache SET hits = hits + 1, last_hit_at = CURRENT_TIMESTAMP
+                   WHERE cache_key = %s AND created_at > CURRENT_TIMESTAMP - %s * INTERVAL '1 second'
+                   RETURNING response""",
+                (key, max_age)
+            )
+        row = cur.fetchone()
+        conn.commit()
+        cur.close()
+        conn.close()
+        return row['response'] if row else None
+    except Exception as e:
+        print(f'[LLM CACHE] Load error: {e}')
+        return None
+
+def load_llm_result(key: str) -> Any:
+    '''
+    Дособранный ответ модели (kind = 'cluster_result') без учёта попаданий.
+    Запись об ошибке старше LLM_FAILURE_TTL не возвращается
+    '''
+    try:
+        dsn = os.environ.get('DATABASE_URL')
+        conn = psycopg2.connect(dsn, cursor_factory=RealDictCursor)
+        cur = conn.cursor()
+        cur.execute(
+            """SELECT response FROM llm_cache
+               WHERE cache_key = %s AND kind = 'cluster_result'
+                 AND (NOT response ? 'error' OR created_at > CURRENT_TIMESTAMP - %s * INTERVAL '1 second')""",
+            (key, LLM_FAILURE_TTL)
+        )
+        row = cur.fetchone()
+        cur.close()
+        conn.close()
+        return row['response'] if row else None
+    except Exception as e:
+        print(f'[LLM CACHE] Result load error: {e}')
+        return None
+
+def store_llm_cache(key: str, kind: str, value: Any):
+    try:
+        dsn = os.environ.get('DATABASE_URL')
+        conn = psycopg2.connect(dsn)
+        cur = conn.cursor()
+        cur.execute(
+            """INSERT INTO llm_cache (cache_key, kind, model, prompt_version, response)
+               VALUES (%s, %s, %s, %s, %s)
+               ON CONFLICT (cache_key) DO UPDATE SET
+                   response = EXCLUDED.response,
+                   created_at = CURRENT_TIMESTAMP""",
+            (key, kind, LLM_MODEL, LLM_PROMPT_VERSIONS[kind], json.dumps(value, ensure_ascii=False))
+        )
+        conn.commit()
+        cur.close()
+        conn.close()
+    except Exception as e:
+        print(f'[LLM CACHE] Store error: {e}')
+
+def remember_llm_value(key: str, value: Any, max_age: Optional[int] = None):
+    '''Копия ответа — в память процесса (не дольше срока жизни вида)'''
+    expires_at = time.time() + min(llm_memory_cache.ttl, max_age) if max_age else None
+    llm_memory_cache.put(key, copy.deepcopy(value), expires_at)
+
+def cached_llm_call(kind: str, items: List[str], params: Dict[str, Any], compute) -> Any:
+    '''
+    Ответ модели из кэша (память процесса → Postgres) или вызов compute().
+    None от compute (ошибка, непрошедшая валидация) не кэшируется.
+    Записи вида из LLM_CACHE_TTLS старше срока считаются промахом.
+    Из памяти возвращается копия — вызывающий может менять ответ
+    '''
+    key = llm_cache_key(kind, items, params)
+    max_age = LLM_CACHE_TTLS.get(kind)
+    value = llm_memory_cache.get(key)
+    if value is not None:
+        llm_cache_stats['memory_hits'] += 1
+        count_stage('llm_cache_hits')
+        return copy.deepcopy(value)
+    
+    value = load_llm_cache(key, max_age)
+    if value is not None:
+        llm_cache_stats['db_hits'] += 1
+        count_stage('llm_cache_hits')
+        remember_llm_value(key, value, max_age)
+        return value
+    
+    llm_cache_stats['misses'] += 1
+    count_stage('llm_cache_misses')
+    value = compute()
+    if value is not None:
+        remember_llm_value(key, value, max_age)
+        store_llm_cache(key, kind, value)
+    return value
+
+def lookup_frequencies(phrases: List[str], regions: List[int], headers: Dict[str, str], budget: float = FREQUENCY_LOOKUP_BUDGET) -> List[Optional[Dict[str, Any]]]:
+    '''
+    Частотность фраз (первая строка topRequests) параллельно, в пределах общего бюджета времени.
+    Порядок результатов совпадает с phrases; не успевшие к дедлайну или с ошибкой — None
+    '''
+    results = [None] * len(phrases)
+    if not phrases:
+        return results
+    deadline = time.monotonic() + budget
+    
+    def lookup(phrase: str) -> Optional[Dict[str, Any]]:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        status, data = fetch_top_requests(phrase, regions, headers, timeout=min(10, remaining), deadline=deadline)
+        top = data.get('topRequests', []) if status == 200 and data else []
+        return top[0] if top else None
+    
+    executor = ThreadPoolExecutor(max_workers=min(WORDSTAT_WORKERS, len(phrases)))
+    futures = {executor.submit(copy_context().run, lookup, phrase): i for i, phrase in enumerate(phrases)}
+    done, pending = wait(futures, timeout=budget)
+    executor.shutdown(wait=False, cancel_futures=True)
+    
+    for future in done:
+        try:
+            results[futures[future]] = future.result()
+        except Exception as e:
+            print(f'[FREQUENCY] Lookup error: {e}')
+    if pending:
+        count_stage('frequency_timeouts', len(pending))
+        print(f'[FREQUENCY] Deadline reached, {len(pending)} of {len(phrases)} lookups dropped')
+    return results
+
+def fetch_seed_phrases(seeds: List[str], regions: List[int], headers: Dict[str, str], num_phrases: int = 2000) -> List[tuple]:
+    '''
+    topRequests для всех сидов параллельно (через кэш и общий лимит Wordstat).
+    Возвращает (status_code, data) по уникальным сидам в исходном порядке. Ошибка отдельного
+    сида только логируется; исключение пробрасывается, если не ответил ни один сид
+    '''
+    unique = {}
+    for seed in seeds:
+        unique.setdefault(canonical_cache_key(seed, regions)[0], seed)
+    unique_seeds = list(unique.values())
+    
+    executor = ThreadPoolExecutor(max_workers=min(WORDSTAT_WORKERS, len(unique_seeds)))
+    futures = [
+        executor.submit(copy_context().run, fetch_top_requests, seed, regions, headers, num_phrases)
+        for seed in unique_seeds
+    ]
+    responses = []
+    first_error = None
+    for seed, future in zip(unique_seeds, futures):
+        try:
+            responses.append(future.result())
+        except Exception as e:
+            print(f'[WORDSTAT] Seed "{seed}" failed: {e}')
+            first_error = first_error or e
+            responses.append((None, None))
+    executor.shutdown()
+    
+    if first_error is not None and not any(status == 200 for status, _ in responses):
+        raise first_error
+    return responses
+
+def merge_top_requests(lists: List[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    '''Объединение выдач сидов: одна запись на нормализованную фразу с максимальной частотностью'''
+    merged = {}
+    for top in lists:
+        for item in top:
+            key = ' '.join(item['phrase'].lower().split())
+            current = merged.get(key)
+            if current is None or item['count'] > current['count']:
+                merged[key] = item
+    return sorted(merged.values(), key=lambda x: x['count'], reverse=True)
+
+GEO_PIPELINE_BUDGET = float(os.environ.get('GEO_PIPELINE_BUDGET', '45'))
+GEO_MAX_LOOKUPS = 15
+GEO_MIN_FREQUENCY = 10
+
+def normalize_address(address: str) -> str:
+    return ' '.join(re.sub(r'[^\w\s-]', ' ', address.lower()).split())
+
+def cached_geo_keywords(address: str, base_query: str) -> List[str]:
+    '''Вариации адреса из OpenAI через кэш LLM по нормализованным (адрес, базовый запрос)'''
+    items = [normalize_address(address), ' '.join(base_query.lower().split())]
+    
+    def generate() -> Optional[List[str]]:
+        with timed('geo_keywords'):
+            return generate_geo_keywords(address, base_query) or None
+    
+    return cached_llm_call('geo', items, {'temperature': 0.7, 'max_tokens': 400}, generate) or []
+
+def collect_geo_phrases(address: str, base_query: str, regions: List[int], headers: Dict[str, str]) -> List[Dict[str, Any]]:
+    '''
+    Геопайплайн: вариации адреса → параллельная проверка частотности через кэш Wordstat.
+    Возвращает фразы с частотностью выше GEO_MIN_FREQUENCY в порядке вариаций
+    '''
+    geo_keywords = cached_geo_keywords(address, base_query)[:GEO_MAX_LOOKUPS]
+    if not geo_keywords:
+        return []
+    count_stage('geo_requests', len(geo_keywords))
+    with timed('geo_lookups'):
+        frequencies = lookup_frequencies(geo_keywords, regions, headers)
+    return [top for top in frequencies if top and top['count'] > GEO_MIN_FREQUENCY]
+
+def pending_llm_result_response(result_key: str) -> Dict[str, Any]:
+    '''
+    Ответ модели, опоздавший к бюджету запроса (PendingLlmResult): 200 — готов,
+    202 — ещё считается, 500 — фон упал, 404 — ключ не от дособранного ответа
+    '''
+    if not re.fullmatch(r'[0-9a-f]{64}', result_key):
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Invalid llm_result key'}),
+            'isBase64Encoded': False
+        }
+    
+    value = llm_result_cache.get(result_key) or load_llm_result(result_key)
+    if value is None:
+        return {
+            'statusCode': 202,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'status': 'pending'}),
+            'isBase64Encoded': False
+        }
+    
+    if not isinstance(value, dict) or not ('error' in value or ('clusters' in value and 'minus_words' in value)):
+        return {
+            'statusCode': 404,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Unknown llm_result key'}),
+            'isBase64Encoded': False
+        }
+    
+    if 'error' in value:
+        return {
+            'statusCode': 500,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'status': 'failed', 'error': value['error']}, ensure_ascii=False),
+            'isBase64Encoded': False
+        }
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps({
+            'success': True,
+            'data': {'Clusters': value['clusters'], 'MinusWords': value['minus_words']}
+        }, ensure_ascii=False),
+        'isBase64Encoded': False
+    }
+
+def store_project_dendrogram(project_id: int, user_id: str, dendrogram: Dict[str, Any]):
+    '''Дендрограмма рядом с results проекта — для перерезки через api (endpoint=recut)'''
+    try:
+        dsn = os.environ.get('DATABASE_URL')
+        conn = psycopg2.connect(dsn)
+        cur = conn.cursor()
+        cur.execute(
+            "UPDATE clustering_projects SET dendrogram = %s WHERE id = %s AND user_id = %s",
+            (json.dumps(dendrogram, ensure_ascii=False), project_id, user_id)
+        )
+        print(f'[DENDROGRAM] Stored for project {project_id}: {cur.rowcount} row(s), {len(dendrogram["merges"])} merges')
+        conn.commit()
+        cur.close()
+        conn.close()
+    except Exception as e:
+        print(f'[DENDROGRAM] Store error: {e}')
+
+def compact_search_query(query: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Компактный формат SearchQuery (body: "format": "compact").
+    Каждая фраза хранится один раз в колонках Phrases, а списки фраз
+    в TopRequests, Clusters, MinusWords и GeoCluster заменены индексами:
+      {
+        "Keyword": str, "Shows": int, "Mode": str,
+        "Phrases": {"phrase": [str, ...], "count": [int, ...]},
+        "TopRequests": [int, ...],
+        "Clusters": [{...поля кластера, "phrases": [int, ...]}, ...],
+        "MinusWords": {категория: {...поля категории, "phrases": [int, ...]}},
+        "GeoCluster": {...поля кластера, "phrases": [int, ...]} | null
+      }
+    Строка таблицы — пара (phrase, count): одна фраза с разной частотностью
+    (например, частотность в кавычках у запросов пользователя) — разные строки
+    '''
+    positions = {}
+    texts = []
+    counts = []
+    
+    def refs(phrases: List[Dict[str, Any]]) -> List[int]:
+        result = []
+        for p in phrases:
+            key = (p['phrase'], p.get('count', 0))
+            position = positions.get(key)
+            if position is None:
+                position = positions[key] = len(texts)
+                texts.append(key[0])
+                counts.append(key[1])
+            result.append(position)
+        return result
+    
+    def group(g: Dict[str, Any]) -> Dict[str, Any]:
+        return {**g, 'phrases': refs(g.get('phrases', []))}
+    
+    compact = {
+        'Keyword': query['Keyword'],
+        'Shows': query['Shows'],
+        'Mode': query['Mode'],
+        'Phrases': None,
+        'TopRequests': refs(query['TopRequests']),
+        'Clusters': [group(c) for c in query['Clusters']],
+        'MinusWords': {},
+        'GeoCluster': group(query['GeoCluster']) if query.get('GeoCluster') else None
+    }
+    for key, value in (query.get('MinusWords') or {}).items():
+        if isinstance(value, dict) and 'phrases' in value:
+            compact['MinusWords'][key] = group(value)
+        elif isinstance(value, list) and all(isinstance(p, dict) for p in value):
+            compact['MinusWords'][key] = refs(value)
+        else:
+            compact['MinusWords'][key] = value
+    compact['Phrases'] = {'phrase': texts, 'count': counts}
+    if 'Dendrogram' in query:
+        compact['Dendrogram'] = query['Dendrogram']
+    return compact
+
+def parse_number_param(body_data: Dict[str, Any], name: str, default: float, low: float, high: float) -> Optional[float]:
+    '''Числовой параметр тела, прижатый к [low, high]; None — не число (строка, bool, NaN, inf)'''
+    value = body_data.get(name, default)
+    if isinstance(value, bool):
+        return None
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    if not math.isfinite(value):
+        return None
+    return min(max(value, low), high)
+
+def encode_json_body(payload: Dict[str, Any], use_gzip: bool) -> tuple:
+    '''JSON тела ответа, при use_gzip — gzip в base64. Returns: (body, is_base64, extra_headers)'''
+    body = json.dumps(payload, ensure_ascii=False)
+    if not use_gzip:
+        return body, False, {}
+    compressed = gzip.compress(body.encode('utf-8'), compresslevel=6)
+    return base64.b64encode(compressed).decode('ascii'), True, {'Content-Encoding': 'gzip'}
+
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Получение данных из Яндекс.Wordstat API с СУПЕР умной кластеризацией
@@ -861,6 +2864,10 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         }
     
     if method == 'GET':
+        query_params = event.get('queryStringParameters') or {}
+        if query_params.get('llm_result'):
+            return pending_llm_result_response(query_params['llm_result'])
+        
         try:
             api_url = 'https://api.wordstat.yandex.net/v1/getRegionsTree'
             headers = {
@@ -916,6 +2923,15 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         object_address: str = body_data.get('objectAddress', '')
         region_names: List[str] = body_data.get('region_names', [])
         selected_intents: List[str] = body_data.get('selected_intents', [])
+        collapse_duplicates: bool = body_data.get('collapse_duplicates', False)
+        include_timings: bool = body_data.get('timings', False)
+        response_format: str = body_data.get('format', 'full')
+        use_gzip: bool = body_data.get('gzip', False)
+        return_dendrogram: bool = body_data.get('return_dendrogram', False)
+        project_id = body_data.get('project_id')
+        idf_blend = parse_number_param(body_data, 'idf_blend', 0, 0.0, 1.0)
+        llm_budget = parse_number_param(body_data, 'llm_budget', LLM_RACE_BUDGET, 0.0, LLM_BUDGET)
+        similarity_backend = 'jaccard' if body_data.get('similarity') == 'jaccard' else 'tfidf'
         
         print(f'[WORDSTAT] Request params: keywords={keywords}, regions={regions}, use_openai={use_openai}')
         print(f'[WORDSTAT] Body data: {body_data}')
@@ -931,14 +2947,61 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'body': json.dumps({'error': 'Необходимо указать ключевые слова'})
             }
         
-        api_url = 'https://api.wordstat.yandex.net/v1/topRequests'
+        if idf_blend is None:
+            return {
+                'statusCode': 400,
+                'headers': {
+                    'Content-Type': 'application/json',
+                    'Access-Control-Allow-Origin': '*'
+                },
+                'isBase64Encoded': False,
+                'body': json.dumps({'error': 'idf_blend должен быть числом от 0 до 1'})
+            }
+        
+        if llm_budget is None:
+            return {
+                'statusCode': 400,
+                'headers': {
+                    'Content-Type': 'application/json',
+                    'Access-Control-Allow-Origin': '*'
+                },
+                'isBase64Encoded': False,
+                'body': json.dumps({'error': f'llm_budget должен быть числом секунд от 0 до {LLM_BUDGET:g}'})
+            }
+        
+        # Дендрограмма — история слияний smart_clusterize: с ней кластеры ответа
+        # считает он, а не TF-IDF по use_openai; у других алгоритмов её нет
+        if return_dendrogram:
+            if body_data.get('algorithm', 'default') != 'default':
+                return {
+                    'statusCode': 400,
+                    'headers': {
+                        'Content-Type': 'application/json',
+                        'Access-Control-Allow-Origin': '*'
+                    },
+                    'isBase64Encoded': False,
+                    'body': json.dumps({'error': 'return_dendrogram поддерживается только алгоритмом default'})
+                }
+            use_openai = False
+        
         headers = {
             'Authorization': f'Bearer {token}',
             'Content-Type': 'application/json; charset=utf-8',
             'Accept-Language': 'ru'
         }
         
+        timer = StageTimer()
+        timer_token = _request_timer.set(timer)
+        geo_executor = None
+        
         try:
+            # Геопайплайн (OpenAI + проверка частотности) идёт в фоне, пока считаются кластеры
+            geo_future = None
+            if object_address and object_address.strip():
+                print(f'[GEO] Generating geo keywords for: {object_address}')
+                geo_executor = ThreadPoolExecutor(max_workers=1)
+                geo_future = geo_executor.submit(copy_context().run, collect_geo_phrases, object_address, keywords[0], regions, headers)
+            
             user_phrases = []
             for kw in keywords:
                 if kw.strip():
@@ -947,30 +3010,26 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         'count': 0
                     })
             
-            payload = {
-                'phrase': keywords[0],
-                'regions': regions,
-                'numPhrases': 2000
-            }
-            
-            print(f'[WORDSTAT] Request payload: phrase={keywords[0]}, regions={regions}, numPhrases=2000')
-            
-            response = requests.post(api_url, json=payload, headers=headers, timeout=30)
-            
-            if response.status_code != 200:
-                return {
-                    'statusCode': response.status_code,
-                    'headers': {
-                        'Content-Type': 'application/json',
-                        'Access-Control-Allow-Origin': '*'
-                    },
-                    'isBase64Encoded': False,
-                    'body': json.dumps({'error': f'API error: {response.status_code}'})
-                }
+            seeds = [p['phrase'] for p in user_phrases]
+            print(f'[WORDSTAT] Request payload: seeds={len(seeds)}, phrase={keywords[0]}, regions={regions}, numPhrases=2000')
             
-            data = response.json()
+            with timed('wordstat_fetch'):
+                seed_responses = fetch_seed_phrases(seeds, regions, headers, num_phrases=2000)
+            seed_results = [data for status, data in seed_responses if status == 200 and 'error' not in data]
             
-            if 'error' in data:
+            if not seed_results:
+                status_code, data = seed_responses[0]
+                if status_code != 200:
+                    return {
+                        'statusCode': status_code or 502,
+                        'headers': {
+                            'Content-Type': 'application/json',
+                            'Access-Control-Allow-Origin': '*'
+                        },
+                        'isBase64Encoded': False,
+                        'body': json.dumps({'error': f'API error: {status_code}'})
+                    }
+                
                 return {
                     'statusCode': 400,
                     'headers': {
@@ -981,24 +3040,73 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'body': json.dumps({'error': data.get('error')})
                 }
             
-            top_requests = data.get('topRequests', [])
+            with timed('seed_merge'):
+                top_requests = merge_top_requests([data.get('topRequests', []) for data in seed_results])
+            first_status, first_data = seed_responses[0]
+            seed_top = first_data.get('topRequests', []) if first_status == 200 and 'error' not in first_data else []
+            if len(seed_results) > 1:
+                print(f'[WORDSTAT] Merged {len(seed_results)} seeds into {len(top_requests)} unique phrases')
             clustering_mode = body_data.get('mode', 'seo')
+            clustering_algorithm = body_data.get('algorithm', 'default')
             print(f'[WORDSTAT] Got {len(top_requests)} phrases from Yandex API, mode: {clustering_mode}')
+            count_stage('phrases', len(top_requests))
             
-            if use_openai:
+            # Почти одинаковые фразы кластеризуем одним представителем,
+            # а в ответе разворачиваем обратно
+            cluster_input = top_requests
+            duplicate_members = {}
+            dendrogram = None
+            pending_llm_key = None
+            if collapse_duplicates:
+                with timed('dedupe'):
+                    cluster_input, duplicate_members = collapse_near_duplicates(top_requests)
+                print(f'[WORDSTAT] Collapsed {len(top_requests)} phrases into {len(cluster_input)} representatives')
+            
+            if clustering_algorithm == 'kmeans':
+                print(f'[WORDSTAT] Using mini-batch k-means clustering')
+                clusters = kmeans_clusterize(cluster_input, mode=clustering_mode, idf_blend=idf_blend)
+                minus_words = {}
+                if clustering_mode == 'context':
+                    minus_words = detect_minus_words(cluster_input)
+            elif clustering_algorithm == 'llm':
+                print('[WORDSTAT] Racing OpenAI clustering against TF-IDF')
+                clusters, minus_words, pending_llm_key = clusterize_with_openai(
+                    cluster_input,
+                    mode=clustering_mode,
+                    region_names=region_names,
+                    selected_intents=selected_intents,
+                    budget=llm_budget,
+                    duplicate_members=duplicate_members
+                )
+            elif use_openai or clustering_algorithm == 'knn':
                 print(f'[WORDSTAT] Using advanced TF-IDF clustering')
                 clusters, minus_words = clusterize_advanced(
-                    top_requests, 
+                    cluster_input, 
                     mode=clustering_mode,
                     region_names=region_names,
-                    selected_intents=selected_intents
+                    selected_intents=selected_intents,
+                    algorithm='knn' if clustering_algorithm == 'knn' else 'greedy',
+                    idf_blend=idf_blend,
+                    similarity=similarity_backend
                 )
             else:
                 print('[WORDSTAT] Using TF-IDF for clustering')
-                clusters = smart_clusterize(top_requests, mode=clustering_mode)
+                if return_dendrogram:
+                    clusters, dendrogram = smart_clusterize(cluster_input, mode=clustering_mode, return_dendrogram=True, idf_blend=idf_blend, similarity=similarity_backend)
+                else:
+                    clusters = smart_clusterize(cluster_input, mode=clustering_mode, idf_blend=idf_blend, similarity=similarity_backend)
                 minus_words = {}
                 if clustering_mode == 'context':
-                    minus_words = detect_minus_words(top_requests)
+                    minus_words = detect_minus_words(cluster_input)
+            
+            if duplicate_members:
+                expand_near_duplicates(clusters, duplicate_members)
+                expand_near_duplicates(minus_words.values(), duplicate_members)
+            if dendrogram:
+                dendrogram['duplicates'] = duplicate_members
+                dendrogram['cut'] = dendrogram_cut(clusters, dendrogram['applied_merges'])
+                if project_id:
+                    store_project_dendrogram(project_id, user_id, dendrogram)
             
             print(f'[WORDSTAT] Created {len(clusters)} smart clusters ({clustering_mode} mode)')
             if minus_words:
@@ -1008,77 +3116,81 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             # Добавляем первый кластер: запросы пользователя в кавычках
             if user_phrases:
                 # Получаем частотность для каждой фразы в кавычках
-                for user_phrase in user_phrases:
-                    try:
-                        payload_user = {'phrase': user_phrase['phrase'], 'regions': regions}
-                        resp_user = requests.post(api_url, json=payload_user, headers=headers, timeout=10)
-                        if resp_user.status_code == 200:
-                            data_user = resp_user.json()
-                            top_req_user = data_user.get('topRequests', [])
-                            if top_req_user:
-                                user_phrase['count'] = top_req_user[0]['count']
-                                print(f"[USER_PHRASES] Got frequency for {user_phrase['phrase']}: {user_phrase['count']}")
-                    except Exception as e:
-                        print(f"[USER_PHRASES] Error getting frequency: {e}")
-                        user_phrase['count'] = 0
+                count_stage('user_phrase_requests', len(user_phrases))
+                with timed('user_phrases'):
+                    frequencies = lookup_frequencies([p['phrase'] for p in user_phrases], regions, headers)
+                for user_phrase, top_req_user in zip(user_phrases, frequencies):
+                    if top_req_user:
+                        user_phrase['count'] = top_req_user['count']
+                        print(f"[USER_PHRASES] Got frequency for {user_phrase['phrase']}: {user_phrase['count']}")
                 
-                user_cluster = {
-                    'cluster_name': '🎯 Ваши запросы',
-                    'total_count': sum(p['count'] for p in user_phrases),
-                    'phrases_count': len(user_phrases),
-                    'avg_words': round(sum(len(p['phrase'].split()) for p in user_phrases) / len(user_phrases), 1) if user_phrases else 0,
-                    'max_frequency': max(p['count'] for p in user_phrases) if user_phrases else 0,
-                    'min_frequency': min(p['count'] for p in user_phrases) if user_phrases else 0,
-                    'intent': 'commercial',
-                    'phrases': sorted(user_phrases, key=lambda x: x['count'], reverse=True)
-                }
+                user_cluster = build_cluster(
+                    '🎯 Ваши запросы',
+                    'commercial',
+                    sorted(user_phrases, key=lambda x: x['count'], reverse=True)
+                )
                 clusters.insert(0, user_cluster)
                 print(f'[USER_PHRASES] Added user cluster with {len(user_phrases)} phrases')
             
-            # Добавляем геоключи, если указан адрес объекта
+            # Геокластер: пайплайн запущен в начале запроса и работал параллельно с кластеризацией
             geo_cluster = None
-            if object_address and object_address.strip():
-                print(f'[GEO] Generating geo keywords for: {object_address}')
-                geo_keywords = generate_geo_keywords(object_address, keywords[0])
-                
-                if geo_keywords:
-                    # Проверяем частотность в Wordstat
+            if geo_future is not None:
+                try:
+                    geo_phrases = geo_future.result(timeout=GEO_PIPELINE_BUDGET)
+                except Exception as e:
+                    print(f'[GEO] Pipeline error: {e}')
                     geo_phrases = []
-                    for geo_kw in geo_keywords[:15]:  # Limit to 15 requests
-                        try:
-                            payload_geo = {'phrase': geo_kw, 'regions': regions}
-                            resp_geo = requests.post(api_url, json=payload_geo, headers=headers, timeout=10)
-                            if resp_geo.status_code == 200:
-                                data_geo = resp_geo.json()
-                                top_req_geo = data_geo.get('topRequests', [])
-                                if top_req_geo and top_req_geo[0]['count'] > 10:  # Min frequency 10
-                                    geo_phrases.append(top_req_geo[0])
-                        except:
-                            pass
-                    
-                    if geo_phrases:
-                        geo_cluster = {
-                            'cluster_name': '📍 Геолокация',
-                            'total_count': sum(p['count'] for p in geo_phrases),
-                            'phrases_count': len(geo_phrases),
-                            'avg_words': round(sum(len(p['phrase'].split()) for p in geo_phrases) / len(geo_phrases), 1),
-                            'max_frequency': max(p['count'] for p in geo_phrases),
-                            'min_frequency': min(p['count'] for p in geo_phrases),
-                            'intent': 'commercial',
-                            'phrases': sorted(geo_phrases, key=lambda x: x['count'], reverse=True)
-                        }
-                        clusters.insert(0, geo_cluster)  # Add as first cluster
-                        print(f'[GEO] Added geo cluster with {len(geo_phrases)} phrases')
+                
+                if geo_phrases:
+                    geo_cluster = build_cluster(
+                        '📍 Геолокация',
+                        'commercial',
+                        sorted(geo_phrases, key=lambda x: x['count'], reverse=True)
+                    )
+                    clusters.insert(0, geo_cluster)  # Add as first cluster
+                    print(f'[GEO] Added geo cluster with {len(geo_phrases)} phrases')
             
             search_query = [{
                 'Keyword': keywords[0],
-                'Shows': top_requests[0]['count'] if top_requests else 0,
+                'Shows': seed_top[0]['count'] if seed_top else 0,
                 'TopRequests': top_requests,
                 'Clusters': clusters,
                 'MinusWords': minus_words,
                 'Mode': clustering_mode,
                 'GeoCluster': geo_cluster
             }]
+            if return_dendrogram:
+                search_query[0]['Dendrogram'] = dendrogram
+            if pending_llm_key:
+                search_query[0]['PendingLlmResult'] = pending_llm_key
+            
+            # Сжатие и кодирование — внутри try, пока таймер запроса ещё установлен
+            response_body = {
+                'success': True,
+                'data': {
+                    'SearchQuery': search_query
+                }
+            }
+            if response_format == 'compact':
+                with timed('compact'):
+                    response_body['format'] = 'compact'
+                    response_body['data']['SearchQuery'] = [compact_search_query(q) for q in search_query]
+            if include_timings:
+                response_body['_timings'] = timer.as_dict()
+            
+            with timed('encode'):
+                body, is_base64, extra_headers = encode_json_body(response_body, use_gzip)
+            
+            return {
+                'statusCode': 200,
+                'headers': {
+                    'Content-Type': 'application/json',
+                    'Access-Control-Allow-Origin': '*',
+                    **extra_headers
+                },
+                'isBase64Encoded': is_base64,
+                'body': body
+            }
         
         except requests.exceptions.Timeout:
             return {
@@ -1103,21 +3215,18 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'isBase64Encoded': False,
                 'body': json.dumps({'error': f'Ошибка: {str(e)}'})
             }
-        
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'isBase64Encoded': False,
-            'body': json.dumps({
-                'success': True,
-                'data': {
-                    'SearchQuery': search_query
-                }
-            }, ensure_ascii=False)
-        }
+        finally:
+            if geo_executor is not None:
+                geo_executor.shutdown(wait=False)
+            with timed('global_idf_flush'):
+                flush_global_idf_if_due()
+            _request_timer.reset(timer_token)
+            print(json.dumps({
+                'event': 'wordstat_timings',
+                'request_id': getattr(context, 'request_id', None),
+                'mode': body_data.get('mode', 'seo'),
+                **timer.as_dict()
+            }, ensure_ascii=False))
     
     return {
         'statusCode': 405,
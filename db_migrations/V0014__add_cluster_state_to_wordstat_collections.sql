@@ -0,0 +1,3 @@
+-- Состояние инкрементальной кластеризации коллекции: счётчики IDF и центроиды кластеров
+ALTER TABLE wordstat_collections
+ADD COLUMN IF NOT EXISTS cluster_state JSONB DEFAULT NULL;
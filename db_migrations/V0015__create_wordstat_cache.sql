@@ -0,0 +1,12 @@
+-- Общий кэш ответов Wordstat topRequests: ключ — нормализованная фраза и отсортированные регионы,
+-- num_phrases — глубина выборки (более глубокая запись обслуживает более мелкие запросы)
+CREATE TABLE IF NOT EXISTS wordstat_cache (
+    phrase TEXT NOT NULL,
+    regions VARCHAR(255) NOT NULL,
+    num_phrases INTEGER NOT NULL,
+    response JSONB NOT NULL,
+    fetched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (phrase, regions)
+);
+
+CREATE INDEX IF NOT EXISTS idx_wordstat_cache_fetched ON wordstat_cache(fetched_at);
\ No newline at end of file
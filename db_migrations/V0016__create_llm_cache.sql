@@ -0,0 +1,14 @@
+-- Контентно-адресуемый кэш ответов LLM (кластеризация, геовариации, названия кластеров).
+-- cache_key — sha256 от модели, версии промпта, отсортированного набора фраз и параметров
+CREATE TABLE IF NOT EXISTS llm_cache (
+    cache_key CHAR(64) PRIMARY KEY,
+    kind VARCHAR(50) NOT NULL,
+    model VARCHAR(100) NOT NULL,
+    prompt_version VARCHAR(50) NOT NULL,
+    response JSONB NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_hit_at TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_llm_cache_kind ON llm_cache(kind);
\ No newline at end of file
@@ -0,0 +1,3 @@
+-- История слияний smart_clusterize: перерезка кластеров проекта без повторного запроса к Wordstat
+ALTER TABLE clustering_projects
+ADD COLUMN IF NOT EXISTS dendrogram JSONB DEFAULT NULL;
\ No newline at end of file
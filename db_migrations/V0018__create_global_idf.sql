@@ -0,0 +1,13 @@
+-- Глобальные документные частоты лемм по всем выгрузкам Wordstat (IDF для кластеризации)
+CREATE TABLE IF NOT EXISTS global_lemma_df (
+    lemma VARCHAR(200) PRIMARY KEY,
+    doc_freq BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Число учтённых фраз (документов); единственная строка id = 1
+CREATE TABLE IF NOT EXISTS global_idf_totals (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    documents BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
\ No newline at end of file